@@ -1,14 +1,56 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import importlib.machinery
+import importlib.util
 import os
 import re
+import shutil
 import subprocess
 import sys
 from datetime import datetime, timedelta
 from pathlib import Path
 
 
+def import_shorten_url():
+    """import shorten_url found in PATH for its daemon client, or None"""
+    path = shutil.which("shorten_url")
+    if path is None:
+        return None
+    loader = importlib.machinery.SourceFileLoader("shorten_url", path)
+    module = importlib.util.module_from_spec(
+        importlib.util.spec_from_loader("shorten_url", loader)
+    )
+    try:
+        loader.exec_module(module)
+    except (OSError, SyntaxError, ImportError):
+        return None
+    return module
+
+
+def shorten_url_message(message):
+    """
+    shorten urls of message with resident shorten_url daemon, spawn
+    shorten_url if daemon is not running
+    """
+    shorten_url = import_shorten_url()
+    results = shorten_url and shorten_url.request_daemon(
+        [message], url_min_length=100, update_message=True
+    )
+    if results:
+        return results[0]
+    result = subprocess.run(
+        [
+            "shorten_url",
+            "--update-message",
+            "--url-min-length=100",
+            message,
+        ],
+        stdout=subprocess.PIPE,
+    )
+    return result.stdout.decode("utf-8")
+
+
 class AddressBook:
     def __init__(self, filename):
         self.filename = filename
@@ -159,16 +201,7 @@ if __name__ == "__main__":
     read_std_lines = sys.stdin.buffer.read().decode("utf-8", "ignore")
 
     try:
-        result = subprocess.run(
-            [
-                "shorten_url",
-                "--update-message",
-                "--url-min-length=100",
-                read_std_lines,
-            ],
-            stdout=subprocess.PIPE,
-        )
-        sys.stdout.write(result.stdout.decode("utf-8").strip())
+        sys.stdout.write(shorten_url_message(read_std_lines).strip())
     except Exception:
         sys.stdout.write(read_std_lines)
 
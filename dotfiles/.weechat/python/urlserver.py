@@ -1,10 +1,13 @@
-from collections import OrderedDict
 import weechat
+import email.utils
+import datetime
 import socket
 import base64
 import string
+import struct
 import html
-import ast
+import mmap
+import time
 import os
 import re
 
@@ -13,7 +16,21 @@ SCRIPT_AUTHOR = 'Sébastien Helleu <flashcode@flashtux.org>'
 SCRIPT_VERSION = '2.6'
 SCRIPT_LICENSE = 'GPL3'
 SCRIPT_DESC = 'Shorten URLs with own HTTP server'
-SCRIPT_FILENAME = '/tmp/shorten_url.list'
+SCRIPT_FILENAME = '/tmp/shorten_url.db'
+
+# store written by shorten_url: slot 0 is the header, slot n the record of
+# short url number n
+STORE_MAGIC = b'SURL'
+STORE_VERSION = 1
+STORE_SLOT_SIZE = 4096
+STORE_MAX_NUMBER = 500
+STORE_HEADER = struct.Struct('<4sHHIIQ')
+STORE_RECORD = struct.Struct('<IdHH')
+
+URLSERVER_YOUTUBE_REGEX = re.compile(r'v=([\w\d]+)')
+URLSERVER_MAX_HEADER_SIZE = 65536
+# a callback running longer than this is reported in debug mode
+URLSERVER_SLOW_MS = 5
 
 SCRIPT_COMMAND = 'urlserver'
 SCRIPT_BUFFER = 'urlserver'
@@ -21,7 +38,19 @@ SCRIPT_BUFFER = 'urlserver'
 urlserver = {
     'socket': None,
     'hook_fd': None,
-    'urls': {},
+    'hook_timer': None,
+    'clients': {},
+    'stats': {'events': 0, 'max_ms': 0.0, 'max_event': None},
+    'store': None,
+    'store_id': None,
+    'sequence': None,
+    'slots': {},
+    'records': [],
+    'rows': {},
+    'urls': [],
+    'pages': {},
+    'modified': 0,
+    'generation': 0,
     'number': 0,
     'buffer': '',
 }
@@ -99,6 +128,12 @@ urlserver_settings_default = {
     'http_open_in_new_page': (
         'on',
         'open links in new pages/tabs'),
+    'http_keepalive_timeout': (
+        '5',
+        'seconds an idle persistent connection is kept open'),
+    'http_keepalive_max': (
+        '100',
+        'maximum number of requests served on one persistent connection'),
     'debug': (
         'off',
         'print some debug messages'),
@@ -159,35 +194,49 @@ def urlserver_get_base_url():
     return '%s://%s%s/%s' % (scheme, hostname, prefixed_port, prefix)
 
 
-def urlserver_server_reply(conn, code, extra_header, message,
+def urlserver_server_reply(request, code, extra_header, message,
                            mimetype='text/html'):
-    """Send a HTTP reply to client."""
+    """
+    Queue a HTTP reply to client, the body is left out for a HEAD request and
+    the connection is announced as closed when it won't be kept alive.
+    """
+    if type(message) is not bytes:
+        message = message.encode('utf-8')
+    headers = ['HTTP/1.1 %s' % code]
     if extra_header:
-        extra_header += '\r\n'
-    s = 'HTTP/1.1 %s\r\n' \
-        '%s' \
-        'Content-Type: %s\r\n' \
-        'Content-Length: %d\r\n' \
-        '\r\n' \
-        % (code, extra_header, mimetype, len(message))
-    msg = None
-    if type(message) is bytes:
-        msg = s.encode('utf-8') + message
-    else:
-        msg = s.encode('utf-8') + message.encode('utf-8')
+        headers.append(extra_header)
+    headers.append('Content-Type: %s' % mimetype)
+    # a 304 has no body, its length would be taken for the cached page's
+    if not code.startswith('304'):
+        headers.append('Content-Length: %d' % len(message))
+    if not request['keep_alive']:
+        headers.append('Connection: close')
+    msg = ('\r\n'.join(headers) + '\r\n\r\n').encode('utf-8')
+    if request['method'] != 'HEAD':
+        msg += message
     if urlserver_settings['debug'] == 'on':
         weechat.prnt('', 'urlserver: sending %d bytes' % len(msg))
-    conn.sendall(msg)
+    request['client']['outbuf'] += msg
 
 
-def urlserver_server_reply_auth_required(conn):
+def urlserver_server_reply_auth_required(request):
     """Reply a 401 (authorization required)."""
-    urlserver_server_reply(conn,
+    urlserver_server_reply(request,
                            '401 Authorization required',
                            'WWW-Authenticate: Basic realm="%s"' % SCRIPT_NAME,
                            '')
 
 
+def urlserver_server_reply_404_not_found(request):
+    """Reply a 404 (not found)."""
+    urlserver_server_reply(request,
+                           '404 Not found', '',
+                           '<html>\n'
+                           '<head><title>Page not found</title></head>\n'
+                           '<body><h1>Page not found</h1></body>\n'
+                           '</html>')
+
+
 def urlserver_server_favicon():
     """Return favicon for HTML page."""
     s = ('iVBORw0KGgoAAAANSUhEUgAAACAAAAAgCAYAAABzenr0AAAABmJLR0QA/wD/AP+g'
@@ -231,55 +280,90 @@ def urlserver_server_favicon():
     return base64_decode(s)
 
 
-def urlserver_server_reply_list(conn, sort='-time'):
-    """Send list of URLs as HTML page to client."""
-    content = '<div class="urls">\n<table id="urls_table">\n'
+def urlserver_render_css():
+    """Return CSS block (or link to external CSS) of HTML page."""
+    if len(urlserver_settings['http_css_url']) > 0:
+        return ('<link rel="stylesheet" type="text/css" href="%s" />' %
+                urlserver_settings['http_css_url'])
+    return ('<style type="text/css" media="screen">'
+            '<!--\n'
+            '  html { font-family: Verdana, Arial, Helvetica; '
+            'font-size: 12px; background: %s; color: %s }\n'
+            '  .urls table { border-collapse: collapse }\n'
+            '  .urls table td,th { border: solid 1px #cccccc; '
+            'padding: 4px; font-size: 12px }\n'
+            '  .timestamp,.number,.short_url{ white-space: nowrap }\n'
+            '  .sorted_by { font-style: italic; }\n'
+            '  .obj { margin-top: 1em }\n'
+            '-->'
+            '</style>\n' % (
+                urlserver_settings['http_bg_color'],
+                urlserver_settings['http_fg_color']))
+
+
+def urlserver_render_list(urls, sort='-time'):
+    """Return list of URLs as HTML page."""
+    content = ['<div class="urls">\n<table id="urls_table">\n', '  <tr>']
     sortkey = {
         '-': ('', '&uarr;'),
         '+': ('-', '&darr;')
     }
-    content += '  <tr>'
     for column, defaultsort in (('time', '-'), ('number', '-')):
         if sort[1:] == column:
-            content += ('<th class="sortable sorted_by %s_header">'
-                        '<a href="sort=%s%s">%s</a> %s</th>' % (
-                            column,
-                            sortkey[sort[0]][0],
-                            column, column.capitalize(),
-                            sortkey[sort[0]][1]))
+            content.append('<th class="sortable sorted_by %s_header">'
+                           '<a href="sort=%s%s">%s</a> %s</th>' % (
+                               column,
+                               sortkey[sort[0]][0],
+                               column, column.capitalize(),
+                               sortkey[sort[0]][1]))
         else:
-            content += ('<th class="sortable %s_header">'
-                        '<a class="sort_link" href="sort=%s%s">%s</a></th>' % (
-                            column,
-                            defaultsort,
-                            column,
-                            column.capitalize()))
-    content += '<th class="unsortable message_header">Short URLs</th>'
-    content += '<th class="unsortable message_header">Convention URLs message</th>'
-    content += '</tr>\n'
-    for key, item in urlserver['urls'].items():
-        content += '  <tr>'
+            content.append('<th class="sortable %s_header">'
+                           '<a class="sort_link" href="sort=%s%s">%s</a>'
+                           '</th>' % (
+                               column,
+                               defaultsort,
+                               column,
+                               column.capitalize()))
+    content.append('<th class="unsortable message_header">Short URLs</th>'
+                   '<th class="unsortable message_header">'
+                   'Convention URLs message</th>'
+                   '</tr>\n')
+
+    # everything which does not depend on the URL is computed once per page
+    short_url_e = '\x01\x02\x03\x04'
+    url_e = '\x05\x06\x07\x08'
+    message_e = html.escape(
+        f"Shorten url script:\t convert {url_e} to {short_url_e}"
+    ).split('\t', 1)
+    strjoin = ('<span class="prefix_suffix"> %s </span>' %
+               urlserver_settings['http_prefix_suffix']
+               .replace(' ', '&nbsp;'))
+    message_e = strjoin.join([
+        '<span class="prefix">%s</span>' % message_e[0],
+        '<span class="message">%s</span>' % message_e[1]])
+    if urlserver_settings['http_open_in_new_page'] == 'on':
+        target = '_blank'
+    else:
+        target = '_self'
+    href = ('</span><a class="%s" href="%s" title="%s" target="%s">'
+            '%s</a><span class="message">')
+    embed_image = urlserver_settings['http_embed_image'] == 'on'
+    embed_youtube = urlserver_settings['http_embed_youtube'] == 'on'
+    try:
+        size = urlserver_settings['http_embed_youtube_size'].split('*')
+        width = int(size[0])
+        height = int(size[1])
+    except:
+        width = 480
+        height = 350
+
+    rows = urlserver['rows']
+    for key, item in urls:
+        if (key, item) in rows:
+            content.append(rows[(key, item)])
+            continue
         short_url = item[1]
-        short_url_e = '\x01\x02\x03\x04'
         url = item[2]
-        url_e = '\x05\x06\x07\x08'
-        message = html.escape(
-            f"Shorten url script:\t convert {url_e} to {short_url_e}"
-        ).split('\t', 1)
-        message[0] = '<span class="prefix">%s</span>' % message[0]
-        message[1] = '<span class="message">%s</span>' % message[1]
-
-        strjoin = ('<span class="prefix_suffix"> %s </span>' %
-                   urlserver_settings['http_prefix_suffix']
-                   .replace(' ', '&nbsp;'))
-
-        if urlserver_settings['http_open_in_new_page'] == 'on':
-            target = '_blank'
-        else:
-            target = '_self'
-
-        href = ('</span><a class="%s" href="%s" title="%s" target="%s">'
-                '%s</a><span class="message">')
         short_url_href = href % (
             "short_url", url, "Short url for link", target, short_url
         )
@@ -290,78 +374,97 @@ def urlserver_server_reply_list(conn, sort='-time'):
             display_url = url
 
         url_href = href % ("url", short_url, "Url for link", target, display_url)
-        message = strjoin.join(message).replace(
+        message = message_e.replace(
             short_url_e, short_url_href).replace(url_e, url_href)
 
         obj = ''
-        if (urlserver_settings['http_embed_image'] == 'on'
-                and url.lower().endswith(
-                    ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.svg')
-                )):
+        if embed_image and url.lower().endswith(
+                ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.svg')):
             obj = ('<div class="obj"><img src="%s" title="%s" alt="%s">'
                    '</div>' % (url, url, url))
-        elif (urlserver_settings['http_embed_youtube'] == 'on'
-              and 'youtube.com/' in url):
-            m = re.search(r'v=([\w\d]+)', url)
+        elif embed_youtube and 'youtube.com/' in url:
+            m = URLSERVER_YOUTUBE_REGEX.search(url)
             if m:
                 yid = m.group(1)
-                try:
-                    size = (urlserver_settings['http_embed_youtube_size']
-                            .split('*'))
-                    width = int(size[0])
-                    height = int(size[1])
-                except:
-                    width = 480
-                    height = 350
                 obj = ('<div class="obj youtube">'
                        '<iframe id="%s" type="text/html" width="%d" '
                        'height="%d" '
                        'src="https://www.youtube.com/embed/%s?enablejsapi=1">'
                        '</iframe></div>' % (yid, width, height, yid))
 
-        content += ('<td class="timestamp">%s</td>'
-                    '<td class="number" style="text-align:center">%s</td>'
-                    '<td class="short_url">%s</td>'
-                    '<td class="message">' % (
-                        key, item[0], item[1]))
-        content += '%s%s</td></tr>\n' % (message, obj)
-    content += '</table>'
+        rows[(key, item)] = ('  <tr><td class="timestamp">%s</td>'
+                             '<td class="number" style="text-align:center">'
+                             '%s</td>'
+                             '<td class="short_url">%s</td>'
+                             '<td class="message">%s%s</td></tr>\n' % (
+                                 key, item[0], item[1], message, obj))
+        content.append(rows[(key, item)])
+    content.append('</table>')
 
-    if len(urlserver_settings['http_css_url']) > 0:
-        css = ('<link rel="stylesheet" type="text/css" href="%s" />' %
-               urlserver_settings['http_css_url'])
+    return ('<html>\n'
+            '<head>\n'
+            '<title>%s</title>\n'
+            '<meta http-equiv="content-type" content="text/html; '
+            'charset=utf-8" />\n'
+            '%s\n'
+            '<base href="%s" />\n'
+            '<link rel="icon" type="image/png" href="favicon.png" />\n'
+            '</head>\n'
+            '<body>\n%s\n</body>\n'
+            '</html>' % (
+                urlserver_settings['http_title'],
+                urlserver_render_css(),
+                urlserver_get_base_url(),
+                ''.join(content)))
+
+
+def urlserver_check_not_modified(data, etag, modified):
+    """Check conditional request headers against a cached page."""
+    m = re.search(r'^If-None-Match:[ \t]*(.+)$', data,
+                  re.MULTILINE | re.IGNORECASE)
+    if m:
+        tags = [tag.strip() for tag in m.group(1).split(',')]
+        return '*' in tags or etag in tags
+    m = re.search(r'^If-Modified-Since:[ \t]*(.+)$', data,
+                  re.MULTILINE | re.IGNORECASE)
+    if m:
+        try:
+            since = email.utils.parsedate_to_datetime(m.group(1).strip())
+            return int(modified) <= since.timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def urlserver_list_page(sort='-time'):
+    """
+    Return (etag, modified, body) of the list page, rendered once per store
+    change and sort order.
+    """
+    global urlserver
+    if sort not in urlserver['pages']:
+        # generation changes with the rendering settings, at startup
+        etag = '"%x-%x-%x-%s"' % ((urlserver['store_id'] or (0, 0))[1],
+                                  urlserver['sequence'] or 0,
+                                  int(urlserver['generation'] * 1000), sort)
+        body = urlserver_render_list(urlserver['urls'], sort).encode('utf-8')
+        modified = max(urlserver['modified'], int(urlserver['generation']))
+        urlserver['pages'][sort] = (etag, modified, body)
+    return urlserver['pages'][sort]
+
+
+def urlserver_server_reply_list(request, sort='-time'):
+    """
+    Send list of URLs as HTML page to client, from the page cache or with
+    a 304.
+    """
+    etag, modified, body = urlserver_list_page(sort)
+    headers = 'ETag: %s\r\nLast-Modified: %s\r\nCache-Control: no-cache' % (
+        etag, email.utils.formatdate(modified, usegmt=True))
+    if urlserver_check_not_modified(request['data'], etag, modified):
+        urlserver_server_reply(request, '304 Not Modified', headers, b'')
     else:
-        css = ('<style type="text/css" media="screen">'
-               '<!--\n'
-               '  html { font-family: Verdana, Arial, Helvetica; '
-               'font-size: 12px; background: %s; color: %s }\n'
-               '  .urls table { border-collapse: collapse }\n'
-               '  .urls table td,th { border: solid 1px #cccccc; '
-               'padding: 4px; font-size: 12px }\n'
-               '  .timestamp,.number,.short_url{ white-space: nowrap }\n'
-               '  .sorted_by { font-style: italic; }\n'
-               '  .obj { margin-top: 1em }\n'
-               '-->'
-               '</style>\n' % (
-                   urlserver_settings['http_bg_color'],
-                   urlserver_settings['http_fg_color']))
-
-    html_code = ('<html>\n'
-                 '<head>\n'
-                 '<title>%s</title>\n'
-                 '<meta http-equiv="content-type" content="text/html; '
-                 'charset=utf-8" />\n'
-                 '%s\n'
-                 '<base href="%s" />\n'
-                 '<link rel="icon" type="image/png" href="favicon.png" />\n'
-                 '</head>\n'
-                 '<body>\n%s\n</body>\n'
-                 '</html>' % (
-                     urlserver_settings['http_title'],
-                     css,
-                     urlserver_get_base_url(),
-                     content))
-    urlserver_server_reply(conn, '200 OK', '', html_code)
+        urlserver_server_reply(request, '200 OK', headers, body)
 
 
 def urlserver_check_auth(data):
@@ -378,106 +481,296 @@ def urlserver_check_auth(data):
     return False
 
 
-def urlserver_server_fd_cb(data, fd):
-    """Callback for server socket."""
-    if not urlserver['socket']:
-        return weechat.WEECHAT_RC_OK
-    conn, addr = urlserver['socket'].accept()
+def urlserver_parse_request(buf):
+    """
+    Parse the request at start of buf, return (request, consumed bytes) or
+    None if it is not complete yet. Raise ValueError for a bad request.
+    """
+    start = 0
+    # empty lines before a request line must be ignored
+    while buf.startswith(b'\r\n', start):
+        start += 2
+    end = buf.find(b'\r\n\r\n', start)
+    if end < 0:
+        if len(buf) - start > URLSERVER_MAX_HEADER_SIZE:
+            raise ValueError('request header too large')
+        return None
+
+    lines = bytes(buf[start:end]).decode('utf-8', 'ignore').split('\r\n')
+    request_line = lines[0].split(' ')
+    if len(request_line) != 3 or not request_line[2].startswith('HTTP/1.'):
+        raise ValueError('bad request line')
+    method, path, version = request_line
+    headers = {}
+    for line in lines[1:]:
+        name, colon, value = line.partition(':')
+        if not colon:
+            raise ValueError('bad header line')
+        headers[name.strip().lower()] = value.strip()
+    if 'chunked' in headers.get('transfer-encoding', '').lower():
+        raise ValueError('chunked request body not supported')
+    # a body is useless for GET/HEAD, but it has to be skipped
+    length = headers.get('content-length', '0')
+    # int() takes signs, blanks and underscores, a negative length would
+    # make the same bytes parse again as another request
+    if not (length.isascii() and length.isdigit()):
+        raise ValueError('bad content-length')
+    length = int(length)
+    consumed = end + 4 + length
+    if len(buf) < consumed:
+        return None
+
+    connection = headers.get('connection', '').lower()
+    if version == 'HTTP/1.0':
+        keep_alive = 'keep-alive' in connection
+    else:
+        keep_alive = 'close' not in connection
+    request = {
+        'method': method,
+        'path': path,
+        'headers': headers,
+        'data': '\n'.join(lines),
+        'keep_alive': keep_alive,
+    }
+    return request, consumed
+
+
+def urlserver_server_request(request):
+    """Queue reply to one parsed request."""
+    data = request['data']
     if urlserver_settings['debug'] == 'on':
-        weechat.prnt('', 'urlserver: connection from %s' % str(addr))
-    if urlserver_settings['http_allowed_ips'] and \
-            not re.match(urlserver_settings['http_allowed_ips'], addr[0]):
+        weechat.prnt('', 'urlserver: %s' % data.partition('\n')[0])
+
+    if request['method'] not in ('GET', 'HEAD'):
+        urlserver_server_reply(request, '405 Method Not Allowed',
+                               'Allow: GET, HEAD', '')
+        return
+    if not request['path'].startswith('/'):
+        urlserver_server_reply_404_not_found(request)
+        return
+
+    referer = 'referer' in request['headers']
+    url = request['path'][1:]
+    if 'favicon.' in url:
+        urlserver_server_reply(request, '200 OK', '',
+                               urlserver_server_favicon(),
+                               mimetype='image/x-icon')
+        return
+
+    # check if prefix is ok (if prefix defined in settings)
+    if urlserver_settings['http_url_prefix']:
+        if url.startswith(urlserver_settings['http_url_prefix']):
+            url = url[len(urlserver_settings['http_url_prefix']):]
+            if url.startswith('/'):
+                url = url[1:]
+        else:
+            if urlserver_settings['debug'] == 'on':
+                weechat.prnt('', 'urlserver: prefix missing')
+            urlserver_server_reply_404_not_found(request)
+            return
+
+    if url.startswith('sort='):
+        # sort asked for list of urls
+        sort = urlserver_sort_view(url[5:])
+        url = ''
+    else:
+        sort = '-time'
+    if not url:
+        # page with list of urls
+        urlserver_read_urls(sort)
+        if urlserver_check_auth(data):
+            urlserver_server_reply_list(request, sort)
+        else:
+            urlserver_server_reply_auth_required(request)
+        return
+
+    # short url, read base62 key and redirect to page
+    try:
+        number = base62_decode(url)
+    except:
+        urlserver_server_reply_404_not_found(request)
+        return
+    long_url = urlserver_search_url(number)
+    authok = (
+        urlserver_settings['http_auth_redirect'] != 'on'
+        or urlserver_check_auth(data)
+    )
+    if authok and long_url:
+        # if we have a referer in request, use meta for
+        # redirection (so that referer is not sent)
+        # otherwise, we can make redirection with HTTP 302
+        if referer:
+            urlserver_server_reply(
+                request, '200 OK', '',
+                '<meta name="referrer" content="never">\n'
+                '<meta http-equiv="refresh" content="0; '
+                'url=%s">' % long_url)
+        else:
+            urlserver_server_reply(request, '302 Found',
+                                   'Location: %s' % long_url, '')
+    else:
+        urlserver_server_reply_auth_required(request)
+
+
+def urlserver_measure(name, start):
+    """Record time spent in a callback of the WeeChat main loop."""
+    elapsed = (time.perf_counter() - start) * 1000
+    stats = urlserver['stats']
+    stats['events'] += 1
+    if elapsed > stats['max_ms']:
+        stats['max_ms'] = elapsed
+        stats['max_event'] = name
+    if urlserver_settings['debug'] == 'on' and elapsed > URLSERVER_SLOW_MS:
+        weechat.prnt('', 'urlserver: %s blocked main loop for %.1f ms' % (
+            name, elapsed))
+
+
+def urlserver_server_fd_cb(data, fd):
+    """Callback for server socket: accept pending connections."""
+    start = time.perf_counter()
+    while urlserver['socket']:
+        try:
+            conn, addr = urlserver['socket'].accept()
+        except (BlockingIOError, InterruptedError):
+            break
+        except OSError as e:
+            weechat.prnt('', '%surlserver: accept error: %s' % (
+                weechat.prefix('error'), e))
+            break
         if urlserver_settings['debug'] == 'on':
-            weechat.prnt('', 'urlserver: IP not allowed')
-        conn.close()
+            weechat.prnt('', 'urlserver: connection from %s' % str(addr))
+        if urlserver_settings['http_allowed_ips'] and \
+                not re.match(urlserver_settings['http_allowed_ips'], addr[0]):
+            if urlserver_settings['debug'] == 'on':
+                weechat.prnt('', 'urlserver: IP not allowed')
+            conn.close()
+            continue
+        conn.setblocking(False)
+        key = str(conn.fileno())
+        urlserver['clients'][key] = {
+            'conn': conn,
+            'inbuf': bytearray(),
+            'outbuf': bytearray(),
+            'hook_read': weechat.hook_fd(conn.fileno(), 1, 0, 0,
+                                         'urlserver_client_read_cb', key),
+            'hook_write': None,
+            'close': False,
+            'served': 0,
+            'last_activity': time.monotonic(),
+        }
+    urlserver_measure('accept', start)
+    return weechat.WEECHAT_RC_OK
+
+
+def urlserver_client_close(key):
+    """Close a client connection and remove its hooks."""
+    client = urlserver['clients'].pop(key, None)
+    if not client:
+        return
+    for hook in ('hook_read', 'hook_write'):
+        if client[hook]:
+            weechat.unhook(client[hook])
+    client['conn'].close()
+
+
+def urlserver_client_flush(key):
+    """Send as much queued reply as socket accepts without blocking."""
+    client = urlserver['clients'][key]
+    try:
+        while client['outbuf']:
+            sent = client['conn'].send(client['outbuf'])
+            del client['outbuf'][:sent]
+    except (BlockingIOError, InterruptedError):
+        pass
+    except OSError:
+        urlserver_client_close(key)
+        return
+    if client['outbuf']:
+        # wait for socket to be writable again
+        if not client['hook_write']:
+            client['hook_write'] = weechat.hook_fd(
+                client['conn'].fileno(), 0, 1, 0,
+                'urlserver_client_write_cb', key)
+    else:
+        if client['hook_write']:
+            weechat.unhook(client['hook_write'])
+            client['hook_write'] = None
+        if client['close']:
+            urlserver_client_close(key)
+
+
+def urlserver_client_read_cb(data, fd):
+    """Callback for client socket readable: parse and reply to requests."""
+    start = time.perf_counter()
+    client = urlserver['clients'].get(data)
+    if not client:
         return weechat.WEECHAT_RC_OK
-    data = None
     try:
-        conn.settimeout(0.3)
-        data = conn.recv(4096).decode('utf-8')
-        data = data.replace('\r\n', '\n')
-    except:
+        chunk = client['conn'].recv(65536)
+    except (BlockingIOError, InterruptedError):
         return weechat.WEECHAT_RC_OK
-    replysent = False
-    referer = re.search('^Referer:', data, re.MULTILINE | re.IGNORECASE)
-    m = re.search('^GET /(.*) HTTP/.*$', data, re.MULTILINE)
-    if m:
-        url = m.group(1)
-        if urlserver_settings['debug'] == 'on':
-            weechat.prnt('', 'urlserver: %s' % m.group(0))
-        if 'favicon.' in url:
-            urlserver_server_reply(conn, '200 OK', '',
-                                   urlserver_server_favicon(),
-                                   mimetype='image/x-icon')
-            replysent = True
-        else:
-            # check if prefix is ok (if prefix defined in settings)
-            prefixok = True
-            if urlserver_settings['http_url_prefix']:
-                if url.startswith(urlserver_settings['http_url_prefix']):
-                    url = url[len(urlserver_settings['http_url_prefix']):]
-                    if url.startswith('/'):
-                        url = url[1:]
-                else:
-                    prefixok = False
-            # prefix ok, go on with url
-            if prefixok:
-                if url.startswith('sort='):
-                    # sort asked for list of urls
-                    sort = url[5:]
-                    url = ''
-                else:
-                    sort = '-time'
-                urlserver_read_urls(sort)
-                if url:
-                    # short url, read base62 key and redirect to page
-                    try:
-                        number = base62_decode(url)
-                    except:
-                        number = -1
-                    if number >= 0:
-                        long_url = urlserver_search_url(number)
-                        authok = (
-                            urlserver_settings['http_auth_redirect'] != 'on'
-                            or urlserver_check_auth(data)
-                        )
-                        if authok and long_url:
-                            # if we have a referer in request, use meta for
-                            # redirection (so that referer is not sent)
-                            # otherwise, we can make redirection with HTTP 302
-                            if referer:
-                                urlserver_server_reply(
-                                    conn, '200 OK', '',
-                                    '<meta name="referrer" content="never">\n'
-                                    '<meta http-equiv="refresh" content="0; '
-                                    'url=%s">' % long_url)
-                            else:
-                                conn.sendall(
-                                    'HTTP/1.1 302\r\n'
-                                    'Location: {}\r\n\r\n'
-                                    .format(long_url)
-                                    .encode('utf-8'))
-                        else:
-                            urlserver_server_reply_auth_required(conn)
-                        replysent = True
-                else:
-                    # page with list of urls
-                    if urlserver_check_auth(data):
-                        urlserver_server_reply_list(conn, sort)
-                    else:
-                        urlserver_server_reply_auth_required(conn)
-                    replysent = True
-            else:
-                if urlserver_settings['debug'] == 'on':
-                    weechat.prnt('', 'urlserver: prefix missing')
-    if not replysent:
-        urlserver_server_reply(conn,
-                               '404 Not found', '',
-                               '<html>\n'
-                               '<head><title>Page not found</title></head>\n'
-                               '<body><h1>Page not found</h1></body>\n'
-                               '</html>')
-    conn.close()
+    except OSError:
+        chunk = b''
+    if not chunk:
+        urlserver_client_close(data)
+        urlserver_measure('read', start)
+        return weechat.WEECHAT_RC_OK
+    client['inbuf'] += chunk
+    client['last_activity'] = time.monotonic()
+    try:
+        max_requests = int(urlserver_settings['http_keepalive_max'])
+    except ValueError:
+        max_requests = 100
+    while not client['close']:
+        try:
+            parsed = urlserver_parse_request(client['inbuf'])
+        except ValueError as e:
+            if urlserver_settings['debug'] == 'on':
+                weechat.prnt('', 'urlserver: %s' % e)
+            client['close'] = True
+            urlserver_server_reply(
+                {'client': client, 'method': 'GET', 'keep_alive': False},
+                '400 Bad Request', '', '')
+            break
+        if parsed is None:
+            break
+        request, consumed = parsed
+        del client['inbuf'][:consumed]
+        client['served'] += 1
+        request['client'] = client
+        if client['served'] >= max_requests:
+            request['keep_alive'] = False
+        urlserver_server_request(request)
+        client['close'] = not request['keep_alive']
+    if client['close']:
+        # stop reading, the connection is closed once reply is sent
+        weechat.unhook(client['hook_read'])
+        client['hook_read'] = None
+    urlserver_client_flush(data)
+    urlserver_measure('read', start)
+    return weechat.WEECHAT_RC_OK
+
+
+def urlserver_client_write_cb(data, fd):
+    """Callback for client socket writable: send rest of queued reply."""
+    start = time.perf_counter()
+    if data in urlserver['clients']:
+        urlserver['clients'][data]['last_activity'] = time.monotonic()
+        urlserver_client_flush(data)
+    urlserver_measure('write', start)
+    return weechat.WEECHAT_RC_OK
+
+
+def urlserver_timer_cb(data, remaining_calls):
+    """Close connections idle for longer than keep-alive timeout."""
+    try:
+        timeout = float(urlserver_settings['http_keepalive_timeout'])
+    except ValueError:
+        timeout = 5
+    now = time.monotonic()
+    for key, client in list(urlserver['clients'].items()):
+        if now - client['last_activity'] > timeout:
+            urlserver_client_close(key)
     return weechat.WEECHAT_RC_OK
 
 
@@ -486,6 +779,11 @@ def urlserver_server_status():
     if urlserver['socket']:
         weechat.prnt('', 'URL server listening on %s' %
                      str(urlserver['socket'].getsockname()))
+        stats = urlserver['stats']
+        weechat.prnt('', '  %d open connection(s), %d event(s) handled, '
+                     'longest event: %s in %.2f ms' % (
+                         len(urlserver['clients']), stats['events'],
+                         stats['max_event'] or '-', stats['max_ms']))
     else:
         weechat.prnt('', 'URL server not running')
 
@@ -496,6 +794,9 @@ def urlserver_server_start():
     if urlserver['socket']:
         weechat.prnt('', 'URL server already running')
         return
+    # pages of an earlier run may differ, in their base URL for one
+    urlserver['generation'] = time.time()
+    urlserver['pages'] = {}
     port = 0
     try:
         port = int(urlserver_settings['http_port'])
@@ -511,10 +812,19 @@ def urlserver_server_start():
         urlserver['socket'] = None
         urlserver_server_status()
         return
-    urlserver['socket'].listen(5)
+    urlserver['socket'].listen(socket.SOMAXCONN)
+    # never block WeeChat main loop, everything is driven by hook_fd
+    urlserver['socket'].setblocking(False)
+    urlserver['stats'] = {'events': 0, 'max_ms': 0.0, 'max_event': None}
     urlserver['hook_fd'] = weechat.hook_fd(urlserver['socket'].fileno(),
                                            1, 0, 0,
                                            'urlserver_server_fd_cb', '')
+    urlserver['hook_timer'] = weechat.hook_timer(1000, 0, 0,
+                                                 'urlserver_timer_cb', '')
+    # parse store and render default list page now, so that first client
+    # does not pay for it in the main loop
+    urlserver_read_urls()
+    urlserver_list_page()
     urlserver_server_status()
 
 
@@ -522,12 +832,17 @@ def urlserver_server_stop():
     """Stop mini HTTP server."""
     global urlserver
     if urlserver['socket'] or urlserver['hook_fd']:
+        for key in list(urlserver['clients']):
+            urlserver_client_close(key)
         if urlserver['socket']:
             urlserver['socket'].close()
             urlserver['socket'] = None
         if urlserver['hook_fd']:
             weechat.unhook(urlserver['hook_fd'])
             urlserver['hook_fd'] = None
+        if urlserver['hook_timer']:
+            weechat.unhook(urlserver['hook_timer'])
+            urlserver['hook_timer'] = None
         weechat.prnt('', 'URL server stopped')
 
 
@@ -558,6 +873,11 @@ def urlserver_config_cb(data, option, value):
     if pos > 0:
         name = option[pos+1:]
         if name in urlserver_settings:
+            # cached pages depend on settings
+            urlserver['generation'] = time.time()
+            urlserver['pages'] = {}
+            urlserver['rows'] = {}
+            urlserver['sequence'] = None
             if name == 'http_allowed_ips':
                 urlserver_settings[name] = re.compile(value)
             else:
@@ -571,35 +891,136 @@ def urlserver_config_cb(data, option, value):
     return weechat.WEECHAT_RC_OK
 
 
+def urlserver_store_open():
+    """Map the URL store, map it again if the file was replaced."""
+    global urlserver
+    st = os.stat(SCRIPT_FILENAME)
+    if (st.st_dev, st.st_ino) != urlserver['store_id']:
+        with open(SCRIPT_FILENAME, 'rb') as f:
+            store = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, slot_size, max_number, _, _ = \
+            STORE_HEADER.unpack_from(store, 0)
+        if (magic, version, slot_size, max_number) != (
+                STORE_MAGIC, STORE_VERSION, STORE_SLOT_SIZE,
+                STORE_MAX_NUMBER):
+            store.close()
+            raise ValueError('not a shorten url store')
+        if urlserver['store']:
+            urlserver['store'].close()
+        urlserver['store'] = store
+        urlserver['store_id'] = (st.st_dev, st.st_ino)
+        urlserver['sequence'] = None
+    return urlserver['store']
+
+
+def urlserver_store_record(store, number):
+    """Return (number, timestamp, short_url, url) of a slot, or None."""
+    if not 0 < number <= STORE_MAX_NUMBER:
+        return None
+    offset = number * STORE_SLOT_SIZE
+    slot_number, ts, short_url_len, url_len = \
+        STORE_RECORD.unpack_from(store, offset)
+    if slot_number != number:
+        return None
+    offset += STORE_RECORD.size
+    short_url = store[offset:offset + short_url_len].decode('utf-8')
+    offset += short_url_len
+    url = store[offset:offset + url_len].decode('utf-8')
+    return number, ts, short_url, url
+
+
+def urlserver_sort_view(sort):
+    """Return one of the known sort orders for a sort given in URL."""
+    return '%s%s' % ('-' if sort.startswith('-') else '+',
+                     'time' if 'time' in sort else 'number')
+
+
+def urlserver_store_header(store):
+    """
+    Return (number, sequence) of store header, both from one read of it and
+    read again until a writer is not changing it meanwhile.
+    """
+    header = STORE_HEADER.unpack_from(store, 0)[4:6]
+    while True:
+        again = STORE_HEADER.unpack_from(store, 0)[4:6]
+        if again == header:
+            return header
+        header = again
+
+
+def urlserver_changed_numbers(number, sequence):
+    """
+    Return numbers of slots written since last read: shorten_url writes
+    records in ring order and counts them in sequence, so only the last ones
+    before header number are read again. Return None if all slots must be.
+    """
+    if urlserver['sequence'] is None or sequence < urlserver['sequence'] \
+            or sequence - urlserver['sequence'] >= STORE_MAX_NUMBER:
+        return None
+    return [(number - 1 - i) % STORE_MAX_NUMBER + 1
+            for i in range(sequence - urlserver['sequence'])]
+
+
 def urlserver_read_urls(sort='-time'):
-    """Read file with URLs."""
+    """Read URLs from store, only slots written since last read are parsed."""
     global urlserver
-    filename = SCRIPT_FILENAME
     try:
-        urls_dict = ast.literal_eval(open(filename, 'r').read())
-        if not "time" in sort:  # sort by timestamp, default format
-            urls_dict = sorted(urls_dict.items(), key=lambda url: url[1][0])
-        urlserver['urls'] = OrderedDict(urls_dict)
+        store = urlserver_store_open()
+        number, sequence = urlserver_store_header(store)
+        # slots written while they are read are read again with the
+        # sequence that covers them
+        while sequence != urlserver['sequence']:
+            numbers = urlserver_changed_numbers(number, sequence)
+            if numbers is None:
+                urlserver['slots'] = {}
+                numbers = range(1, STORE_MAX_NUMBER + 1)
+            time_format = urlserver_settings['http_time_format']
+            for number in numbers:
+                record = urlserver_store_record(store, number)
+                if record:
+                    _, ts, short_url, url = record
+                    urlserver['slots'][number] = (
+                        ts,
+                        datetime.datetime.fromtimestamp(ts).strftime(
+                            time_format),
+                        (number, short_url, url))
+                else:
+                    urlserver['slots'].pop(number, None)
+            records = sorted(urlserver['slots'].values())
+            urlserver['records'] = [record[1:] for record in records]
+            urlserver['rows'] = {
+                record: urlserver['rows'][record]
+                for record in urlserver['records']
+                if record in urlserver['rows']}
+            urlserver['number'] = number
+            urlserver['modified'] = records[-1][0] if records else 0
+            urlserver['pages'] = {}
+            urlserver['sequence'] = sequence
+            number, sequence = urlserver_store_header(store)
+        urls = urlserver['records']
+        if not 'time' in sort:  # sort by timestamp, default order
+            urls = sorted(urls, key=lambda url: url[1][0])
         if sort.startswith('-'):
-            urlserver['urls'] = OrderedDict(
-                reversed(
-                    list(urlserver['urls'].items())
-                )
-            )
-        urlserver['number'] = list(urlserver['urls'].values())[-1][0]
+            urls = urls[::-1]
+        urlserver['urls'] = urls
     except:
+        urlserver['urls'] = []
+        urlserver['pages'] = {}
+        urlserver['sequence'] = None
         weechat.prnt(
             '', '%surlserver: error reading file "%s"' % (
-                weechat.prefix('error'), filename
+                weechat.prefix('error'), SCRIPT_FILENAME
             )
         )
 
 
 def urlserver_search_url(number):
-    for val in urlserver['urls'].values():
-        if val[0] == number:
-            return val[2]
-    return None
+    """Return long URL of a short number, read straight from its slot."""
+    try:
+        record = urlserver_store_record(urlserver_store_open(), number)
+    except:
+        return None
+    return record[3] if record else None
 
 
 def urlserver_end():
@@ -2,8 +2,11 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import importlib.machinery
+import importlib.util
 import json
 import re
+import shutil
 import subprocess
 import sys
 from collections import OrderedDict
@@ -128,21 +131,46 @@ def hyperlinks_text(url: str, hyper_txt: str) -> str:
     return hyperlinks.format("", url, hyper_txt)
 
 
+def import_shorten_url():
+    """Import shorten_url found in PATH for its daemon client, or None."""
+    if (path := shutil.which("shorten_url")) is None:
+        return None
+    loader = importlib.machinery.SourceFileLoader("shorten_url", path)
+    module = importlib.util.module_from_spec(
+        importlib.util.spec_from_loader("shorten_url", loader)
+    )
+    try:
+        loader.exec_module(module)
+    except (OSError, SyntaxError, ImportError):
+        return None
+    return module
+
+
+def request_shorten_url(messages: list, url_min_length: int) -> list | None:
+    """Ask resident shorten_url daemon, None if it is not running."""
+    if (shorten_url := import_shorten_url()) is None:
+        return None
+    return shorten_url.request_daemon(messages, url_min_length)
+
+
 def search_and_short_url(urls: str, sep=" ") -> str:
+    hrefs = [
+        re.sub(r"[\s\|]", "", href)
+        for href in re.compile(r'<a href="(?P<url>[^"]+)"').findall(urls)
+    ]
+    if not hrefs:
+        return str()
+    # one round trip to the daemon, else one shorten_url batch for all hrefs
+    if (results := request_shorten_url(hrefs, 16)) is None:
+        output = subprocess.run(
+            ["shorten_url", "--url-min-length=16", "-0"],
+            input="\0".join(hrefs).encode("utf-8"),
+            stdout=subprocess.PIPE,
+        ).stdout.decode("utf-8")
+        results = [result or None for result in output.split("\0")[:-1]]
     url_list = list()
-    for href in re.compile(r'<a href="(?P<url>[^"]+)"').findall(urls):
-        if (
-            url := subprocess.run(
-                [
-                    "shorten_url",
-                    "--url-min-length=16",
-                    re.sub(r"[\s\|]", "", href),
-                ],
-                stdout=subprocess.PIPE,
-            )
-            .stdout.decode("utf-8")
-            .strip()
-        ) not in url_list:
+    for url in results:
+        if (url := str(url).strip()) not in url_list:
             url_list.append(url)
     return sep.join(url_list)
 
@@ -4,18 +4,23 @@
 import re
 import os
 import time
+import random
+import bisect
 import string
 import signal
+import argparse
 import subprocess
 import configparser
+from collections import OrderedDict
 from xml.sax.saxutils import escape
 
 import gi
+gi.require_version('GdkPixbuf', '2.0')
 gi.require_version('GdkX11', '3.0')
 gi.require_version('Gtk', '3.0')
 gi.require_version('Keybinder', '3.0')
 gi.require_version('Wnck', '3.0')
-from gi.repository import Gtk, Wnck, Keybinder, Gdk, GdkX11, Pango
+from gi.repository import Gtk, Wnck, Keybinder, Gdk, GdkPixbuf, GdkX11, Pango
 
 
 # Python GObject Introspection API Reference available at
@@ -28,23 +33,138 @@ from gi.repository import Gtk, Wnck, Keybinder, Gdk, GdkX11, Pango
 
 
 class FuzzyMatcher():
+    # Scores like the '.*?' joined regex it replaces, the leftmost start and
+    # the span of the lazy match from there, which is the greedy subsequence
+    # starting at the first occurrence of the first character
 
     def __init__(self, pattern):
-        self.pattern = self.setPattern(pattern)
+        self.pattern = pattern
 
-    @classmethod
-    def setPattern(cls, pattern):
-        return re.compile('.*?'.join(map(re.escape, list(pattern))))
+    @staticmethod
+    def index(text):
+        positions = {}
+        for i, c in enumerate(text):
+            positions.setdefault(c, []).append(i)
+        return positions
+
+    @staticmethod
+    def advance(positions, pattern, start=None, end=0):
+        # Match pattern greedily from end on, None when it doesn't fit
+        for c in pattern:
+            occurrences = positions.get(c)
+            if not occurrences:
+                return None
+            i = bisect.bisect_left(occurrences, end)
+            if i == len(occurrences):
+                return None
+            if start is None:
+                start = occurrences[i]
+            end = occurrences[i] + 1
+        return start, end
 
-    def score(self, string):
-        match = self.pattern.search(string)
+    @staticmethod
+    def weigh(match):
         if match is None:
             return 0
-        else:
-            return (
-                100.0 / (1 + match.start())
-                + 120.0 / (match.end() - match.start() + 1)
-            )
+        start, end = match
+        if start is None:
+            start = end
+        return 100.0 / (1 + start) + 120.0 / (end - start + 1)
+
+    def score(self, text):
+        return self.weigh(self.advance(self.index(text), self.pattern))
+
+
+class FuzzyRanker():
+    # Ranks many strings against a query that is typed one character at a
+    # time, the positions are indexed once and a growing query carries on
+    # from the previous matches
+
+    def __init__(self):
+        self.items = {}
+        self.query = ''
+
+    def add(self, key, *strings):
+        self.items[key] = {
+            'positions': [FuzzyMatcher.index(s.lower()) for s in strings],
+            'matches': None
+        }
+
+    def remove(self, key):
+        self.items.pop(key, None)
+
+    def rank(self, text):
+        query = text.lower()
+        narrowing = query.startswith(self.query)
+        suffix = query[len(self.query):]
+
+        scores = {}
+        for key, item in self.items.items():
+            if narrowing and item['matches'] is not None:
+                # Strings that didn't match the prefix can't match now
+                matches = [
+                    FuzzyMatcher.advance(positions, suffix, *match)
+                    if match else None
+                    for positions, match in zip(item['positions'],
+                                                item['matches'])
+                ]
+            else:
+                matches = [FuzzyMatcher.advance(positions, query)
+                           for positions in item['positions']]
+            item['matches'] = matches
+            scores[key] = sum(map(FuzzyMatcher.weigh, matches))
+
+        self.query = query
+        return scores
+
+
+def benchmark(titles):
+    # Compare with the regex matcher on synthetic titles, typing a query
+    # one character at a time
+    rnd = random.Random(0)
+    words = ['terminal', 'mozilla', 'firefox', 'vim', 'aaaaaaaaaa', 'make',
+             'nimbler.py', 'issue', 'review', 'bash', 'mmmmmm', '~/src']
+    items = {
+        i: (' '.join(rnd.choice(words) for _ in range(rnd.randint(2, 30))),
+            rnd.choice(['Xfce4-terminal', 'Firefox', 'Code', 'Gimp']))
+        for i in range(titles)
+    }
+    query = 'firmake'
+
+    begin = time.perf_counter()
+    expected = []
+    for n in range(1, len(query) + 1):
+        pattern = re.compile('.*?'.join(map(re.escape, query[:n])))
+        scores = {}
+        for key, (name, class_group) in items.items():
+            score = 0
+            for text in (name.lower(), class_group.lower()):
+                match = pattern.search(text)
+                if match is not None:
+                    score += (100.0 / (1 + match.start())
+                              + 120.0 / (match.end() - match.start() + 1))
+            scores[key] = score
+        expected.append(scores)
+    regex_time = time.perf_counter() - begin
+
+    begin = time.perf_counter()
+    ranker = FuzzyRanker()
+    for key, strings in items.items():
+        ranker.add(key, *strings)
+    index_time = time.perf_counter() - begin
+    begin = time.perf_counter()
+    results = [ranker.rank(query[:n]) for n in range(1, len(query) + 1)]
+    rank_time = time.perf_counter() - begin
+
+    for scores, ranked in zip(expected, results):
+        for key, score in scores.items():
+            if abs(score - ranked[key]) > 1e-9:
+                raise SystemExit(f'Score mismatch for {items[key]!r}')
+
+    print(f'{titles} titles, {len(query)} keystrokes')
+    print(f'regex:  {regex_time * 1000:.1f} ms')
+    print(f'ranker: {rank_time * 1000:.1f} ms, '
+          f'plus {index_time * 1000:.1f} ms indexing once')
 
 
 class KeyBindings():
@@ -89,6 +209,9 @@ class DPIScaling():
 
 class WindowList():
 
+    # Scaled icons kept around, most applications have one per class group
+    icon_cache_size = 64
+
     def __init__(self, ignored_windows, always_show_windows,
                  ignored_window_types, icon_size, win_size):
         self.ignored_windows = ignored_windows
@@ -96,40 +219,117 @@ class WindowList():
         self.ignored_window_types = ignored_window_types
         self.icon_size = icon_size
         self.win_size = win_size
+        self.icon_cache = OrderedDict()
+
+        # Live window model, kept up to date from Wnck signals so that
+        # showing the switcher needs no round trips to the X server
+        self.model = {}
+        self.ranker = FuzzyRanker()
+        self.dirty = True
+        self.screen = Wnck.Screen.get_default()
+        self.screen.connect('window-opened', self.windowOpened)
+        self.screen.connect('window-closed', self.windowClosed)
+        self.screen.connect('active-workspace-changed', self.invalidate)
+        self.screen.connect('workspace-created', self.invalidate)
+        self.screen.connect('workspace-destroyed', self.invalidate)
+        # Only forced once, from here on the main loop delivers the events
+        self.screen.force_update()
+        for window in self.screen.get_windows():
+            self.windowOpened(self.screen, window)
+
+    def windowOpened(self, screen, window):
+        xid = window.get_xid()
+        if xid in self.model:
+            return
+
+        self.model[xid] = {
+            'window': window,
+            'entry': {
+                'name': '',
+                'class_group': '',
+                'window_xid': xid,
+                'rank': 0
+            },
+            'shown': False
+        }
+        window.connect('name-changed', self.windowChanged)
+        window.connect('class-changed', self.windowChanged)
+        window.connect('workspace-changed', self.invalidate)
+        window.connect('icon-changed', self.windowIconChanged)
+        self.windowChanged(window)
+        self.dirty = True
+
+    def windowClosed(self, screen, window):
+        if self.model.pop(window.get_xid(), None) is not None:
+            self.ranker.remove(window.get_xid())
+            self.dirty = True
+
+    def windowChanged(self, window):
+        item = self.model.get(window.get_xid())
+        if item is None:
+            return
+
+        name = window.get_name()
+        item['entry']['name'] = name
+        class_group = str(window.get_class_group_name()).capitalize()
+        # The workspace layout groups windows by class
+        if class_group != item['entry']['class_group']:
+            item['entry']['class_group'] = class_group
+            self.dirty = True
+        if item['entry']['class_group']:
+            self.ranker.add(item['entry']['window_xid'],
+                            name, item['entry']['class_group'])
+        else:
+            self.ranker.add(item['entry']['window_xid'], name)
+
+        # Filter out extraneous windows, once per change instead of per show
+        shown = self.isWindowAlwaysShown(name) or not (
+            window.get_window_type() in self.ignored_window_types
+            or self.isWindowIgnored(name))
+        if shown != item['shown']:
+            item['shown'] = shown
+            self.dirty = True
+
+    def windowIconChanged(self, window):
+        item = self.model.get(window.get_xid())
+        if item is None:
+            return
+
+        class_group = item['entry']['class_group']
+        for key in [k for k in self.icon_cache if k[0] == class_group]:
+            del self.icon_cache[key]
+        self.dirty = True
+
+    def invalidate(self, *args):
+        self.dirty = True
 
     def refresh(self):
-        # Get the screen and force update
-        screen = Wnck.Screen.get_default()
-        screen.force_update()
+        for item in self.model.values():
+            item['entry']['rank'] = 0
 
-        self.workspaces = screen.get_workspaces()
-        active_workspace_id = self.workspaces.index(screen.get_active_workspace())
+        # Nothing moved since the last show, the layout is still valid
+        if not self.dirty:
+            self.window_list_ranked = list(self.window_list_merged)
+            return False
+        self.dirty = False
+
+        self.workspaces = self.screen.get_workspaces()
+        active_workspace_id = self.workspaces.index(
+            self.screen.get_active_workspace())
 
         # Clear existing
         app_dict = {"Xfce4-terminal": 0, "Firefox-esr": 1, "Firefox": 2}
         windows = {i: [{}] * len(app_dict) for i in range(len(self.workspaces))}
 
-        # Get a list of windows
-        for i in screen.get_windows():
-            name = i.get_name()
-            workspace = i.get_workspace()
-            class_group = str(i.get_class_group_name()).capitalize()
-
-            # Filter out extraneous windows
-            if not self.isWindowAlwaysShown(name):
-                if i.get_window_type() in self.ignored_window_types:
-                    continue
-                if self.isWindowIgnored(name):
-                    continue
+        for item in self.model.values():
+            if not item['shown']:
+                continue
 
+            workspace = item['window'].get_workspace()
             id = (self.workspaces.index(workspace)
                      if workspace else active_workspace_id)
-            cur_window_dict = {
-                'name': name,
-                'class_group': class_group,
-                'window_xid': i.get_xid(),
-                'rank': 0
-            }
+            cur_window_dict = item['entry']
+            class_group = cur_window_dict['class_group']
 
             if (class_group in app_dict
                     and not windows[id][app_dict[class_group]]):
@@ -150,31 +350,63 @@ class WindowList():
         self.window_list_merged = [
             item for sublist in self.windows.values() for item in sublist
         ]
+        self.window_list_ranked = list(self.window_list_merged)
+        return True
 
     @staticmethod
     def get_window_by_xid(window_xid):
         return Wnck.Window.get(window_xid)
 
-    def get_icon(self, window_xid):
+    def get_icon(self, window_xid, size=None):
+        item = self.model.get(window_xid)
+        if item is None:
+            window = self.get_window_by_xid(window_xid)
+            class_group = str(window.get_class_group_name()).capitalize()
+        else:
+            window = item['window']
+            class_group = item['entry']['class_group']
+
+        # Icons are shared by class group and scaled once per row height
+        key = (class_group, self.icon_size, size)
+        icon = self.icon_cache.get(key)
+        if icon is not None:
+            self.icon_cache.move_to_end(key)
+            return icon
+
         if self.icon_size == 'default' or type(self.icon_size) is int:
-            return self.get_window_by_xid(window_xid).get_icon()
+            icon = window.get_icon()
         elif self.icon_size == 'mini':
-            return self.get_window_by_xid(window_xid).get_mini_icon()
+            icon = window.get_mini_icon()
+        else:
+            return None
+
+        # Only ever scale down, blown up mini icons look worse than a gap,
+        # the longer side is fitted so the aspect ratio is kept
+        width, height = icon.get_width(), icon.get_height()
+        if size and max(width, height) > size:
+            scale = size / max(width, height)
+            icon = icon.scale_simple(max(1, round(width * scale)),
+                                     max(1, round(height * scale)),
+                                     GdkPixbuf.InterpType.BILINEAR)
+
+        self.icon_cache[key] = icon
+        if len(self.icon_cache) > self.icon_cache_size:
+            self.icon_cache.popitem(last=False)
+        return icon
 
     def getHighestRanked(self):
-        return (self.window_list_merged[0]
-                if len(self.window_list_merged)
+        return (self.window_list_ranked[0]
+                if len(self.window_list_ranked)
                 else {})
 
     def rank(self, text):
-        fuzzyMatcher = FuzzyMatcher(text.lower())
+        scores = self.ranker.rank(text)
         for i in self.window_list_merged:
-            score = fuzzyMatcher.score(i['name'].lower())
-            if i['class_group']:
-                score += fuzzyMatcher.score(i['class_group'].lower())
-            i['rank'] = score
+            i['rank'] = scores.get(i['window_xid'], 0)
 
-        self.window_list_merged.sort(key=lambda x: x['rank'], reverse=True)
+        # The merged list keeps its order, shortcuts are bound to it
+        self.window_list_ranked = sorted(
+            self.window_list_merged, key=lambda x: x['rank'], reverse=True)
 
     def isWindowIgnored(self, window_title):
         for pattern in self.ignored_windows:
@@ -198,6 +430,15 @@ class NimblerWindow(Gtk.Window):
 
         # Window is initially hidden
         self.hidden = True
+        # Keep the widgets around between shows instead of rebuilding them
+        self.persistent = config.persistent
+        self.show_latency = config.show_latency
+        self.grid = None
+        self.rows = []
+        self.row_widgets = []
+        # Actions waiting for the switcher to be unmapped
+        self.pending = []
+        self.hotkey_time = None
         self.set_default_size(config.win_size[0], config.win_size[1])
         self.set_resizable(True)
 
@@ -237,8 +478,16 @@ class NimblerWindow(Gtk.Window):
 
         # Register events
         self.connect("key-press-event", self.keypress)
+        self.connect("unmap-event", self.unmapped)
+        self.connect("map-event", self.mapped)
 
     def populate(self):
+        # Rows are built when the window list changes, searching only
+        # restyles them
+        for widget in self.row_widgets:
+            widget.destroy()
+        self.row_widgets = []
+        self.rows = []
         self.window_counter = 0
         self.num_workspaces = len(self.windowList.windows)
 
@@ -263,12 +512,16 @@ class NimblerWindow(Gtk.Window):
             i_column_left = i * (i_column_width + 1)
             self.grid.attach(workspace_button, i_column_left+i_label_width, 0,
                              i_column_width, j_row_height)
+            self.row_widgets.append(workspace_button)
 
             for j, win in enumerate(v):
                 j4grid_top = (j + 1) * j_row_height
                 name = win['name']
-                icon = self.windowList.get_icon(win['window_xid'])
-                binding = self.numbering[self.window_counter]
+                icon = self.windowList.get_icon(win['window_xid'], j_row_height)
+                # Windows past the numbering are still listed, unbound
+                binding = (self.numbering[self.window_counter]
+                           if self.window_counter < len(self.numbering)
+                           else '')
 
                 # Shows what key to press
                 binding_label = Gtk.Label()
@@ -306,7 +559,7 @@ class NimblerWindow(Gtk.Window):
                 button = Gtk.Button()
                 button.set_relief(Gtk.ReliefStyle.NONE)
                 button.set_size_request(i_column_width, j_row_height)
-                button.set_name(binding)
+                button.set_name(str(self.window_counter))
                 # button.set_sensitive(False) needs to be trigged when searching
                 button.connect('clicked', self.present_window_via_button)
                 button.connect('focus', self.highlightButton)
@@ -316,6 +569,16 @@ class NimblerWindow(Gtk.Window):
                 button.add(button_box)
                 self.grid.attach(button, i_column_left+i_label_width, j4grid_top,
                                  i_column_width, j_row_height)
+                self.row_widgets.extend((binding_label, button))
+                self.rows.append({
+                    'window': win,
+                    'name': name,
+                    'label': button_label,
+                    'name_width': name_width,
+                    'button': button,
+                    'sensitive': True,
+                    'highlighted': False,
+                })
 
                 # Up the overall counter
                 self.window_counter += 1
@@ -325,8 +588,8 @@ class NimblerWindow(Gtk.Window):
         workspace = re.sub('[^0-9]', '', label)
         workspace = int(workspace) - 1
 
-        self.toggle()
-        self.windowList.workspaces[workspace].activate(self.getXTime())
+        self.hideThen(lambda: self.windowList.workspaces[workspace].activate(
+            self.getXTime()))
 
     def activate_workspace_via_button(self, button):
         name = button.get_name()
@@ -337,7 +600,34 @@ class NimblerWindow(Gtk.Window):
 
         if text:
             self.windowList.rank(text)
-            self.populate()
+        self.updateRows(bool(text))
+
+    def updateNames(self):
+        # Renamed windows keep their row, only the label text changes
+        for row in self.rows:
+            name = row['window']['name']
+            if row['name'] != name:
+                row['label'].set_text(name[:row['name_width']])
+                row['name'] = name
+
+    def updateRows(self, searching):
+        # Grey out the rows not matching the search and highlight the best
+        # one, only widgets whose state changes are touched
+        highestRanked = self.windowList.getHighestRanked()
+        for row in self.rows:
+            win = row['window']
+            sensitive = not searching or win['rank'] > 0
+            highlighted = (searching and win is highestRanked
+                           and win['rank'] > 0)
+            if row['sensitive'] != sensitive:
+                row['button'].set_sensitive(sensitive)
+                row['sensitive'] = sensitive
+            if row['highlighted'] != highlighted:
+                if highlighted:
+                    self.highlightButton(row['button'], None)
+                else:
+                    self.clearButton(row['button'], None)
+                row['highlighted'] = highlighted
 
     def highlightButton(self, button, event):
         rgba = Gdk.RGBA(0.5, 0.5, 0.2, 1)
@@ -351,8 +641,8 @@ class NimblerWindow(Gtk.Window):
         WindowList.get_window_by_xid(window_xid).close(self.getXTime())
 
     def close_window_via_number(self, window_number):
-        self.toggle()
-        self.close_window(
+        self.hideThen(
+            self.close_window,
             self.windowList.window_list_merged[window_number]['window_xid']
         )
 
@@ -365,19 +655,38 @@ class NimblerWindow(Gtk.Window):
         window.activate(self.getXTime())
 
     def present_window_via_button(self, button):
-        name = button.get_name()
-        window_number = self.numbering.index(name)
+        window_number = int(button.get_name())
         self.present_window_via_number(window_number)
 
     def present_window_via_number(self, window_number):
-        self.toggle()
-        self.presentWindow(
+        self.hideThen(
+            self.presentWindow,
             self.windowList.window_list_merged[window_number]['window_xid']
         )
 
+    def hideThen(self, callback, *args):
+        # Switching away while the switcher is still mapped and focused
+        # fails, so the action waits for the unmap notify of our window
+        if self.hidden:
+            callback(*args)
+        else:
+            self.pending.append((callback, args))
+            self.toggle()
+
+    def unmapped(self, widget, event):
+        pending, self.pending = self.pending, []
+        for callback, args in pending:
+            callback(*args)
+        return False
+
+    def mapped(self, widget, event):
+        if self.show_latency and self.hotkey_time is not None:
+            latency = (time.monotonic() - self.hotkey_time) * 1000
+            print(f'Shown {latency:.1f} ms after the hotkey')
+        self.hotkey_time = None
+        return False
+
     def presentByShortcut(self, event, keyval):
-        time.sleep(0.1)  # workaround to avoid switch window failure
-        self.getXTime()
         # Workspace shortcuts
         if keyval in self.function_keys_keyvals:
             index = self.keybindings.get_keyvals_from_name().index(keyval)
@@ -408,8 +717,7 @@ class NimblerWindow(Gtk.Window):
         index = indices[0]
         windows = self.windowList.window_list_merged
         if index < len(windows):
-            self.toggle()
-            self.presentWindow(windows[index]['window_xid'])
+            self.hideThen(self.presentWindow, windows[index]['window_xid'])
 
     def keypress(self, widget, event):
         # Support pressing numbers on keypad
@@ -436,10 +744,9 @@ class NimblerWindow(Gtk.Window):
                     keyval = Gdk.unicode_to_keyval(number)
                     self.presentByShortcut(event, keyval)
                 elif len(text) > 3:
-                    if self.windowList.max_windows > 0:
-                        if self.windowList.window_list_merged[0]['rank'] > 0:
-                            self.present_window_via_number(0)
-                            return True
+                    if self.windowList.getHighestRanked().get('rank', 0) > 0:
+                        self.hideThen(self.presentHighestRanked)
+                        return True
                     self.toggle()
                     subprocess.Popen(["xfce4-appfinder"], start_new_session=True)
                 return True
@@ -456,37 +763,42 @@ class NimblerWindow(Gtk.Window):
 
     def toggle(self):
         if self.hidden:
-            self.windowList.refresh()
-            self.grid = Gtk.Grid()
-            self.grid.set_column_homogeneous(False)
-            self.grid.set_row_homogeneous(False)
-            # self.grid.set_column_spacing(5)
-            # self.grid.set_row_spacing(20)
-            self.frame.add(self.grid)
-
-            # Set up the box to enter an app name
-            self.enteredName = Gtk.Entry()
-            # Set up event
-            self.enteredName.connect("changed", self.enteredNameChanged)
-            self.grid.attach(self.enteredName, 1, 0,
-                             self.windowList.win_size[0], 1)
-            self.enteredName.set_no_show_all(True)
-
-            # Register enteredName event
-            self.enteredName.connect('changed', self.enteredNameChanged)
+            changed = self.windowList.refresh()
+            if self.grid is None:
+                self.grid = Gtk.Grid()
+                self.grid.set_column_homogeneous(False)
+                self.grid.set_row_homogeneous(False)
+                # self.grid.set_column_spacing(5)
+                # self.grid.set_row_spacing(20)
+                self.frame.add(self.grid)
+
+                # Set up the box to enter an app name
+                self.enteredName = Gtk.Entry()
+                # Set up event
+                self.enteredName.connect("changed", self.enteredNameChanged)
+                self.grid.attach(self.enteredName, 1, 0,
+                                 self.windowList.win_size[0], 1)
+                self.enteredName.set_no_show_all(True)
+                changed = True
 
             self.resize(self.windowList.win_size[0],
                         self.windowList.win_size[1])
-            # Populate windows
-            self.populate()
+            # Populate windows, the rows are reused while nothing moved
+            if changed:
+                self.populate()
+            else:
+                self.updateNames()
+
+            # Clear out the text field, which also resets the search styling
+            self.enteredName.set_text('')
+            self.enteredName.hide()
 
             # Set state
             self.hidden = False
-            self.show_all()
-
-            # Clear out the text field
-            # self.enteredName.set_text('')
-            # self.enteredName.grab_focus()
+            if changed:
+                self.show_all()
+            else:
+                self.show()
 
             # Show our window with focus
             self.stick()
@@ -494,11 +806,17 @@ class NimblerWindow(Gtk.Window):
             self.get_window().focus(time)
         else:
             self.hidden = True
-            self.grid.destroy()
+            # Just an unmap, unless asked not to keep the widgets around
             self.hide()
-            self.resize(1, 1)
+            if not self.persistent:
+                self.grid.destroy()
+                self.grid = None
+                self.rows = []
+                self.row_widgets = []
+                self.resize(1, 1)
 
     def hotkey(self, key, data):
+        self.hotkey_time = time.monotonic()
         self.toggle()
 
     def getXTime(self):
@@ -534,6 +852,8 @@ class Config:
             self.getOption('icon_size', 'default'))
         self.win_size = list(
             map(int, self.getOption('win_size', '800x400').lower().split('x')))
+        self.persistent = bool(int(self.getOption('persistent', 1)))
+        self.show_latency = bool(int(self.getOption('show_latency', 0)))
 
     def getOption(self, option_name, default_value):
         if self.config.has_option('DEFAULT', option_name):
@@ -635,6 +955,14 @@ def nimbler():
 
 
 def main():
+    parser = argparse.ArgumentParser(description='Nimbler window switcher')
+    parser.add_argument('--benchmark', metavar='TITLES', type=int,
+                        help='benchmark the fuzzy ranking on synthetic titles')
+    args = parser.parse_args()
+    if args.benchmark:
+        benchmark(args.benchmark)
+        return
+
     pidfile = "/tmp/nimbler.pid"
 
     if os.path.isfile(pidfile):
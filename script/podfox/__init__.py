@@ -4,30 +4,52 @@
 
 Usage:
     podfox.py import <feed-url> [<shortname>] [-c=<path>]
-    podfox.py update [<shortname>] [-c=<path>]
+    podfox.py import --from-file=<path> [-c=<path>] [-j=<n>]
+    podfox.py update [<shortname>] [-c=<path>] [-j=<n>]
     podfox.py feeds [-c=<path>]
     podfox.py episodes <shortname> [-c=<path>]
-    podfox.py download [<shortname> --how-many=<n>] [-c=<path>]
+    podfox.py download [<shortname> --how-many=<n>] [-c=<path>] [-j=<n>] [--rate=<KiB/s>]
     podfox.py rename <shortname> <newname> [-c=<path>]
+    podfox.py benchmark [--episodes=<n>]
+    podfox.py benchmark-http [--requests=<n>]
+    podfox.py check-feed <feed-url>
 
 Options:
     -c --config=<path>    Specify an alternate config file [default: ~/.podfox.json]
+    -j --jobs=<n>         Number of feeds or episodes fetched in parallel
+    --from-file=<path>    Import every feed url listed in a file, one per line
+    --rate=<KiB/s>        Bandwidth cap for all downloads together
+    --episodes=<n>        Episodes of the synthetic benchmark feed [default: 10000]
+    --requests=<n>        Requests of the http benchmark [default: 200]
     -h --help     Show this help
 """
 # (C) 2015 Bastian Reitemeier
 # mail(at)brtmr.de
 
 from colorama import Fore, Back, Style
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from docopt import docopt
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from os.path import expanduser
 from sys import exit
+from urllib.parse import urlsplit
+from urllib3.util.retry import Retry
+from xml.etree import ElementTree
+import base64
 import colorama
 import feedparser
+import hashlib
+import io
+import itertools
 import json
 import os
 import os.path
 import requests
+import sqlite3
 import sys
+import tempfile
+import threading
+import time
 
 # RSS datetimes follow RFC 2822, same as email headers.
 # this is the chain of stackoverflow posts that led me to believe this is true.
@@ -36,11 +58,70 @@ import sys
 # http://stackoverflow.com/questions/885015/
 # how-to-parse-a-rfc-2822-date-time-into-a-python-datetime
 
+from datetime import datetime
 from email.utils import parsedate
 from time import mktime
 
 CONFIGURATION = {}
 
+# feeds fetched in parallel, and at most this many at once from one host,
+# both can be set in the configuration file.
+DEFAULT_JOBS = 8
+DEFAULT_HOST_CONNECTIONS = 2
+FETCH_TIMEOUT = 30
+# an update stops reading a feed after this many known episodes in a
+# row, a single old pinned item does not end it.
+KNOWN_EPISODES_STOP = 5
+# episodes downloaded in parallel, 'download-rate' caps their total
+# bandwidth in KiB/s.
+DEFAULT_DOWNLOAD_JOBS = 4
+DOWNLOAD_CHUNK_SIZE = 1024**2
+DOWNLOAD_TIMEOUT = 30
+PROGRESS_INTERVAL = 0.2
+
+# one pooled session for feeds and downloads, connections to a host are
+# kept alive and reused, at most 'host-pool-size' of them per host.
+DEFAULT_HOST_POOL_SIZE = 8
+HTTP_RETRIES = 3
+HTTP_BACKOFF = 0.5
+
+host_slots = {}
+host_slots_lock = threading.Lock()
+session = None
+session_lock = threading.Lock()
+
+# episodes of all feeds live in this database in the podcast directory,
+# feed.json only keeps what describes the feed itself.
+EPISODES_DB = 'podfox.db'
+EPISODES_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS episodes (
+        id INTEGER PRIMARY KEY,
+        feed TEXT NOT NULL,
+        title TEXT NOT NULL,
+        url TEXT NOT NULL,
+        guid TEXT NOT NULL DEFAULT '',
+        published REAL NOT NULL,
+        downloaded INTEGER NOT NULL DEFAULT 0,
+        listened INTEGER NOT NULL DEFAULT 0,
+        sha256 TEXT NOT NULL DEFAULT ''
+    );
+    CREATE INDEX IF NOT EXISTS episodes_newest
+        ON episodes (feed, published DESC);
+    CREATE INDEX IF NOT EXISTS episodes_undownloaded
+        ON episodes (feed, downloaded, published DESC);
+'''
+EPISODE_COLUMNS = ('id', 'title', 'url', 'guid', 'published', 'downloaded',
+                   'listened', 'sha256')
+
+db = None
+
+# feed elements are only taken from plain rss or these namespaces, so
+# extensions like itunes:title never shadow the standard elements.
+FEED_NAMESPACES = (
+    'http://www.w3.org/2005/Atom',
+    'http://purl.org/rss/1.0/',
+)
+
 mimetypes = [
     'audio/ogg',
     'audio/mpeg',
@@ -66,37 +147,173 @@ def get_feed_file(shortname):
     return os.path.join(get_folder(shortname), 'feed.json')
 
 
-def sort_feed(feed):
-    feed['episodes'] = sorted(feed['episodes'], key=lambda k: k['published'],
-                              reverse=True)
+def get_db():
+    '''
+    the episodes database, opened on first use. only the main thread
+    touches it, workers get what they need passed in.
+    '''
+    global db
+    if db is None:
+        filename = os.path.join(CONFIGURATION['podcast-directory'],
+                                EPISODES_DB)
+        db = sqlite3.connect(filename, timeout=30)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.executescript(EPISODES_SCHEMA)
+        columns = [row[1] for row in db.execute('PRAGMA table_info(episodes)')]
+        if 'sha256' not in columns:  # database of an older podfox
+            db.execute("ALTER TABLE episodes "
+                       "ADD COLUMN sha256 TEXT NOT NULL DEFAULT ''")
+    return db
+
+
+def load_episodes(shortname, downloaded=None, limit=-1):
+    '''
+    episodes of a feed newest first, optionally only the (not) downloaded
+    ones, straight from the indexes.
+    '''
+    query = 'SELECT {} FROM episodes WHERE feed = ?'.format(
+        ', '.join(EPISODE_COLUMNS))
+    args = [shortname]
+    if downloaded is not None:
+        query += ' AND downloaded = ?'
+        args.append(int(downloaded))
+    query += ' ORDER BY published DESC, id LIMIT ?'
+    args.append(limit)
+    episodes = []
+    for row in get_db().execute(query, args):
+        episode = dict(zip(EPISODE_COLUMNS, row))
+        episode['downloaded'] = bool(episode['downloaded'])
+        episode['listened'] = bool(episode['listened'])
+        episodes.append(episode)
+    return episodes
+
+
+def insert_episodes(shortname, episodes, replace=False):
+    '''
+    store new episodes of a feed in one transaction, with replace the
+    episodes stored so far are dropped first.
+    '''
+    with get_db() as conn:
+        if replace:
+            conn.execute('DELETE FROM episodes WHERE feed = ?', (shortname,))
+        for episode in episodes:
+            cursor = conn.execute(
+                'INSERT INTO episodes (feed, title, url, guid, published, '
+                'downloaded, listened) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (shortname, episode['title'], episode['url'],
+                 episode.get('guid', ''), episode['published'],
+                 int(episode['downloaded']), int(episode['listened'])))
+            episode['id'] = cursor.lastrowid
+
+
+def mark_downloaded(episode, sha256=''):
+    with get_db() as conn:
+        conn.execute('UPDATE episodes SET downloaded = 1, sha256 = ? '
+                     'WHERE id = ?', (sha256, episode['id']))
+    episode['downloaded'] = True
+    episode['sha256'] = sha256
+
+
+def rename_episodes(shortname, newname):
+    with get_db() as conn:
+        conn.execute('UPDATE episodes SET feed = ? WHERE feed = ?',
+                     (newname, shortname))
+
+
+def episode_counts(shortname):
+    '''
+    returns the number of episodes, of downloaded ones, and whether the
+    newest one is downloaded.
+    '''
+    conn = get_db()
+    total, downloaded = conn.execute(
+        'SELECT count(*), total(downloaded) FROM episodes WHERE feed = ?',
+        (shortname,)).fetchone()
+    newest = conn.execute(
+        'SELECT downloaded FROM episodes WHERE feed = ? '
+        'ORDER BY published DESC, id LIMIT 1', (shortname,)).fetchone()
+    return total, int(downloaded), not newest or bool(newest[0])
+
+
+def known_episode_keys(shortname):
+    known = set()
+    for published, title, guid in get_db().execute(
+            'SELECT published, title, guid FROM episodes WHERE feed = ?',
+            (shortname,)):
+        known.update(episode_keys(
+            {'published': published, 'title': title, 'guid': guid}))
+    return known
+
+
+def read_feed_file(filename):
+    '''
+    load a feed.json, the episodes list written by older podfox versions
+    is moved into the database on the way.
+    '''
+    with open(filename, 'r') as f:
+        feed = json.load(f)
+    if 'episodes' in feed:
+        insert_episodes(feed['shortname'], feed.pop('episodes'),
+                        replace=True)
+        write_feed_file(feed)
     return feed
 
 
+def episode_keys(episode):
+    '''
+    the identities of an episode: its guid when the feed gives one, and
+    the published time and title podfox always compared.
+    '''
+    keys = [(episode['published'], episode['title'])]
+    if episode.get('guid'):
+        keys.append(episode['guid'])
+    return keys
+
+
+def merge_episodes(known, episodes):
+    '''
+    returns the previously unknown episodes newest first, known holds the
+    keys of the stored episodes and is updated with the new ones.
+    '''
+    new_episodes = []
+    for episode in episodes:
+        keys = episode_keys(episode)
+        if known.isdisjoint(keys):
+            known.update(keys)
+            new_episodes.append(episode)
+    new_episodes.sort(key=lambda k: k['published'], reverse=True)
+    return new_episodes
+
+
 def import_feed(url, shortname=''):
     '''
     creates a folder for the new feed, and then inserts a new feed.json
     that will contain all the necessary information about this feed, and
     all the episodes contained.
     '''
-    # configuration for this feed, will be written to file.
-    feed = {}
     #get the feed.
-    d = feedparser.parse(url)
+    d = fetch_feed({'url': url})
+    try:
+        feed = create_feed(url, d, shortname)
+    except ValueError as e:
+        print_err(str(e))
+        exit(-1)
+    print('imported ' +
+          Fore.GREEN + feed['title'] + Fore.RESET + ' with shortname ' +
+          Fore.BLUE + feed['shortname'] + Fore.RESET)
 
-    if shortname:
-        folder = get_folder(shortname)
-        if os.path.exists(folder):
-            print_err(
-                '{} already exists'.format(folder))
-            exit(-1)
-        else:
-            os.makedirs(folder)
+
+def create_feed(url, d, shortname=''):
+    '''
+    store the fetched feed d. the folder is only created once the
+    shortname is known to be usable, a ValueError tells why it is not.
+    '''
     #if the user did not specify a folder name,
     #we have to create one from the title
     if not shortname:
         # the rss advertises a title, lets use that.
-        if hasattr(d['feed'], 'title'):
-            title = d['feed']['title']
+        if d.get('title'):
+            title = d['title']
         # still no succes, lets use the last part of the url
         else:
             title = url.rsplit('/', 1)[-1]
@@ -107,61 +324,340 @@ def import_feed(url, shortname=''):
                 if ch.isalnum() or ch == ' ')
         shortname = title.replace(' ', '-').lower()
         if not shortname:
-            print_err('could not auto-deduce shortname.')
-            print_err('please provide one explicitly.')
-            exit(-1)
-        folder = get_folder(shortname)
-        if os.path.exists(folder):
-            print_err(
-                '{} already exists'.format(folder))
-            exit(-1)
-        else:
-            os.makedirs(folder)
-    #we have succesfully generated a folder that we can store the files
-    #in
-    #trawl all the entries, and find links to audio files.
-    feed['episodes'] = episodes_from_feed(d)
+            raise ValueError('could not auto-deduce shortname, '
+                             'please provide one explicitly.')
+    folder = get_folder(shortname)
+    if os.path.exists(folder):
+        raise ValueError('{} already exists'.format(folder))
+    # configuration for this feed, will be written to file.
+    feed = {}
     feed['shortname'] = shortname
-    feed['title'] = d['feed']['title']
+    feed['title'] = d.get('title') or shortname
     feed['url'] = url
+    remember_validators(feed, d)
+    #trawl all the entries, and find links to audio files.
+    episodes = sorted(d['episodes'], key=lambda k: k['published'],
+                      reverse=True)
+    os.makedirs(folder)
     # write the configuration to a feed.json within the folder
     feed_file = get_feed_file(shortname)
-    feed = sort_feed(feed)
+    insert_episodes(shortname, episodes, replace=True)
     with open(feed_file, 'x') as f:
         json.dump(feed, f, indent=4)
-    print('imported ' +
-          Fore.GREEN + feed['title'] + Fore.RESET + ' with shortname ' +
-          Fore.BLUE + feed['shortname'] + Fore.RESET)
+    update_index(feed)
+    return feed
+
+
+def import_feeds(filename, jobs=None):
+    '''
+    import every feed url listed in filename. all urls are probed at
+    once, then imported in file order: a url already imported, or that
+    resolves to a feed imported before, is skipped. a report of every url
+    is printed at the end.
+    '''
+    with open(filename, 'r') as f:
+        urls = list(dict.fromkeys(
+            line.strip() for line in f
+            if line.strip() and not line.lstrip().startswith('#')))
+    feeds = available_feeds()
+    imported = {feed['url']: feed['shortname'] for feed in feeds}
+    todo = [url for url in urls if url not in imported]
+    jobs = jobs or CONFIGURATION.get('jobs', DEFAULT_JOBS)
+    report = []
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(fetch_feed, {'url': url}) for url in todo]
+        # feeds stored before their resolved url was kept are probed as
+        # well, with their validators that is a 304 most of the time
+        resolved = {}
+        probes = {}
+        for feed in feeds:
+            if feed.get('resolved-url'):
+                resolved[feed['resolved-url']] = feed['shortname']
+            elif todo:
+                probes[pool.submit(fetch_feed, feed)] = feed['shortname']
+        for future, shortname in probes.items():
+            try:
+                resolved[future.result()['url']] = shortname
+            except Exception:
+                pass
+        for url in urls:
+            if url in imported:
+                report.append((url, None,
+                               'already imported as ' + imported[url]))
+                continue
+            try:
+                d = futures[todo.index(url)].result()
+                if d['url'] in resolved:
+                    raise ValueError('same feed as ' + resolved[d['url']])
+                feed = create_feed(url, d)
+            except Exception as e:
+                # a broken feed must not abort the rest of the import
+                report.append((url, False, str(e) or type(e).__name__))
+                continue
+            resolved[d['url']] = feed['shortname']
+            report.append((url, True, 'imported as ' + feed['shortname']))
+    print('='*80)
+    for url, ok, message in report:
+        line = '{0:50.50} | {1}'.format(url, message)
+        if ok:
+            print_green(line)
+        elif ok is None:
+            print(line)
+        else:
+            print_err(line)
+    print('{} imported, {} skipped or failed'.format(
+        len([ok for url, ok, message in report if ok]),
+        len([ok for url, ok, message in report if not ok])))
+
+
+def host_slot(url):
+    '''
+    returns the semaphore limiting concurrent connections to the host of
+    url.
+    '''
+    host = urlsplit(url).netloc
+    with host_slots_lock:
+        if host not in host_slots:
+            host_slots[host] = threading.BoundedSemaphore(
+                CONFIGURATION.get('host-connections',
+                                  DEFAULT_HOST_CONNECTIONS))
+        return host_slots[host]
+
+
+def get_session():
+    '''
+    the http session shared by all threads. failed connections and
+    temporary server errors are retried with an exponential backoff.
+    '''
+    global session
+    with session_lock:
+        if session is None:
+            pool_size = CONFIGURATION.get('host-pool-size',
+                                          DEFAULT_HOST_POOL_SIZE)
+            retries = Retry(total=HTTP_RETRIES, backoff_factor=HTTP_BACKOFF,
+                            status_forcelist=(429, 500, 502, 503, 504),
+                            allowed_methods=('GET', 'HEAD'))
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=pool_size, pool_maxsize=pool_size,
+                max_retries=retries)
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+        return session
+
+
+def fetch_feed(feed, known=None):
+    '''
+    download the feed and parse it while it streams in, this is safe to
+    run in a worker thread. returns a dict with the http status, the
+    validators, the channel title and the episodes.
+    given the known episode keys, reading stops once the feed reaches
+    episodes we already have, everything after them is older.
+    '''
+    headers = {}
+    if feed.get('etag'):
+        headers['If-None-Match'] = feed['etag']
+    if feed.get('modified'):
+        headers['If-Modified-Since'] = feed['modified']
+    known = known or set()
+    with host_slot(feed['url']):
+        with get_session().get(feed['url'], headers=headers, stream=True,
+                               timeout=FETCH_TIMEOUT) as r:
+            r.raise_for_status()
+            fetched = {
+                'url': r.url,
+                'status': r.status_code,
+                'etag': r.headers.get('ETag'),
+                'modified': r.headers.get('Last-Modified'),
+                'episodes': [],
+            }
+            if r.status_code == 304:
+                return fetched
+            r.raw.decode_content = True
+            known_run = 0
+            try:
+                for episode in stream_episodes(r.raw, fetched):
+                    fetched['episodes'].append(episode)
+                    if known.isdisjoint(episode_keys(episode)):
+                        known_run = 0
+                    else:
+                        known_run += 1
+                        if known_run == KNOWN_EPISODES_STOP:
+                            break
+                return fetched
+            except ElementTree.ParseError:
+                pass
+        # not well formed, let the forgiving parser have a go at it
+        r = get_session().get(feed['url'], timeout=FETCH_TIMEOUT)
+        r.raise_for_status()
+    d = feedparser.parse(r.content)
+    return {
+        'url': r.url,
+        'status': r.status_code,
+        'etag': r.headers.get('ETag'),
+        'modified': r.headers.get('Last-Modified'),
+        'title': d['feed'].get('title'),
+        'episodes': episodes_from_feed(d),
+    }
+
+
+def stream_episodes(stream, channel):
+    '''
+    parse an rss or atom document as it is read and yield its episodes.
+    the channel title is stored in channel. items are dropped from the
+    tree once handled, so memory does not grow with the document.
+    '''
+    parents = []
+    for event, elem in ElementTree.iterparse(stream, ('start', 'end')):
+        if event == 'start':
+            parents.append(elem)
+            continue
+        parents.pop()
+        tag = feed_tag(elem)
+        if tag in ('item', 'entry'):
+            yield from episodes_from_item(elem)
+            if parents:
+                parents[-1].remove(elem)
+        elif tag == 'title' and 'title' not in channel and parents and \
+                feed_tag(parents[-1]) in ('channel', 'feed'):
+            channel['title'] = (elem.text or '').strip()
+
+
+def feed_tag(elem):
+    '''
+    the local name of a plain rss, rss 1.0 or atom element, None for an
+    element of any other namespace.
+    '''
+    namespace, _, tag = elem.tag.rpartition('}')
+    if namespace and namespace[1:] not in FEED_NAMESPACES:
+        return None
+    return tag
+
+
+def episodes_from_item(item):
+    '''
+    the episodes of one rss item or atom entry, as episodes_from_feed()
+    makes them from a parsed feed.
+    '''
+    fields = {}
+    links = []
+    for child in item:
+        tag = feed_tag(child)
+        if tag is None:
+            continue
+        fields.setdefault(tag, (child.text or '').strip())
+        if tag == 'enclosure':
+            links.append((child.get('url'), child.get('type')))
+        elif tag == 'link' and child.get('rel') == 'enclosure':
+            links.append((child.get('href'), child.get('type')))
+    if fields.get('pubDate'):
+        date = parsedate(fields['pubDate'])
+        if date is None:
+            return []
+        date = mktime(date)
+    elif fields.get('published') or fields.get('updated'):
+        try:
+            date = datetime.fromisoformat(
+                fields.get('published') or fields['updated']).timestamp()
+        except ValueError:
+            return []
+    else:
+        return []
+    return [{
+        'title':      fields.get('title') or href,
+        'url':        href,
+        'guid':       fields.get('guid') or fields.get('id', ''),
+        'downloaded': False,
+        'listened':   False,
+        'published':  date
+        } for href, link_type in links if href and link_type in mimetypes]
+
+
+def remember_validators(feed, d):
+    '''
+    keep the ETag and Last-Modified of the fetched document, they are
+    sent back on the next fetch so an unchanged feed costs a 304 only.
+    the url the feed redirected to is kept too, bulk imports compare it.
+    '''
+    for key in ('etag', 'modified'):
+        if d.get(key):
+            feed[key] = d[key]
+        else:
+            feed.pop(key, None)
+    feed['resolved-url'] = d['url']
 
 
-def update_feed(feed):
+def update_feed(feed, d=None, known=None):
     '''
     download the current feed, and insert previously unknown
     episodes into our local config.
+    returns the number of new episodes.
     '''
-    d = feedparser.parse(feed['url'])
+    if known is None:
+        known = known_episode_keys(feed['shortname'])
+    if d is None:
+        d = fetch_feed(feed, known)
+    # not modified since last fetch, nothing to parse nor to write
+    if d.get('status') == 304:
+        return 0
+    remember_validators(feed, d)
     #only append new episodes!
-    for episode in episodes_from_feed(d):
-        found = False
-        for old_episode in feed['episodes']:
-            if episode['published'] == old_episode['published'] \
-                    and episode['title'] == old_episode['title']:
-                found = True
-        if not found:
-            feed['episodes'].append(episode)
-            print('new episode.')
-    feed = sort_feed(feed)
+    new_episodes = merge_episodes(known, d['episodes'])
+    insert_episodes(feed['shortname'], new_episodes)
+    for episode in new_episodes:
+        print('new episode.')
     overwrite_config(feed)
+    return len(new_episodes)
 
 
-def overwrite_config(feed):
+def update_feeds(feeds, jobs=None):
     '''
-    after updating the feed, or downloading new items,
-    we want to update our local config to reflect that fact.
+    fetch and parse all feeds in parallel. each feed is merged and
+    written from this thread as soon as it arrives, so no two writes
+    ever race. a summary of new episodes per feed is printed at the end.
+    '''
+    jobs = jobs or CONFIGURATION.get('jobs', DEFAULT_JOBS)
+    summary = {}
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = {}
+        for feed in feeds:
+            known = known_episode_keys(feed['shortname'])
+            futures[pool.submit(fetch_feed, feed, known)] = (feed, known)
+        for future in as_completed(futures):
+            feed, known = futures[future]
+            try:
+                d = future.result()
+            except Exception as e:
+                print_err('updating {} failed: {}'.format(feed['title'], e))
+                summary[feed['title']] = None
+                continue
+            print_green('updating {}'.format(feed['title']))
+            summary[feed['title']] = update_feed(feed, d, known)
+    print('='*80)
+    for title, new in sorted(summary.items()):
+        if new is None:
+            print_err('{0:45.45} | failed'.format(title))
+        else:
+            print('{0:45.45} | {1} new'.format(title, new))
+
+
+def overwrite_config(feed, old_shortname=None):
     '''
+    after updating the feed, we want to update our local config to
+    reflect that fact. episodes are in the database, this only writes
+    the small feed.json, aside then renamed so an interrupted write never
+    leaves a truncated feed.json behind.
+    '''
+    write_feed_file(feed)
+    update_index(feed, old_shortname)
+
+
+def write_feed_file(feed):
     filename = get_feed_file(feed['shortname'])
-    with open(filename, 'w') as f:
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'w') as f:
         json.dump(feed, f, indent=4)
+    os.replace(tmp_filename, filename)
 
 
 def episodes_from_feed(d):
@@ -182,6 +678,7 @@ def episodes_from_feed(d):
                     episodes.append({
                         'title':      episode_title,
                         'url':        link.href,
+                        'guid':       entry.get('id', ''),
                         'downloaded': False,
                         'listened':   False,
                         'published':  date
@@ -189,41 +686,231 @@ def episodes_from_feed(d):
     return episodes
 
 
-def download_multiple(feed, maxnum):
-    for episode in feed['episodes']:
-        if maxnum == 0:
-            break
-        if not episode['downloaded']:
-            download_single(feed['shortname'], episode['url'])
-            episode['downloaded'] = True
-            maxnum -= 1
-    overwrite_config(feed)
+def download_multiple(feed, maxnum, jobs=None, rate=None):
+    download_episodes([feed], maxnum, jobs, rate)
+
+
+def download_episodes(feeds, maxnum, jobs=None, rate=None):
+    '''
+    download up to maxnum new episodes of every feed, several transfers
+    at once. each episode is flagged as downloaded as soon as its own
+    transfer finishes, an interrupted run resumes the unfinished ones
+    next time.
+    '''
+    todo = []
+    for feed in feeds:
+        episodes = load_episodes(feed['shortname'], downloaded=False,
+                                 limit=maxnum)
+        todo.extend((feed, episode) for episode in episodes)
+    if not todo:
+        return
+    jobs = jobs or CONFIGURATION.get('download-jobs', DEFAULT_DOWNLOAD_JOBS)
+    rate = rate or CONFIGURATION.get('download-rate')
+    progress = {
+        'lock': threading.Lock(),
+        'stop': threading.Event(),
+        'limiter': {
+            'lock': threading.Lock(),
+            'rate': rate and rate * 1024,
+            'next': 0,
+        },
+        'transfers': {},
+        'episodes': len(todo),
+        'finished': 0,
+        'start': time.perf_counter(),
+        'drawn': 0,
+    }
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = {
+            pool.submit(download_single, feed['shortname'], episode['url'],
+                        progress): (feed, episode)
+            for feed, episode in todo
+        }
+        try:
+            for future in as_completed(futures):
+                feed, episode = futures[future]
+                try:
+                    filename, sha256 = future.result()
+                except Exception as e:
+                    progress_print(progress, print_err,
+                                   '{} failed: {}'.format(episode['url'], e))
+                    continue
+                mark_downloaded(episode, sha256)
+                update_index(feed)
+                progress['finished'] += 1
+                progress_print(progress, print_green,
+                               '{:s} done.'.format(filename))
+        except KeyboardInterrupt:
+            # let the transfers stop at their next chunk, .part files stay,
+            # and drop the queued ones before they send any request
+            progress['stop'].set()
+            pool.shutdown(wait=True, cancel_futures=True)
+            raise
+    print()
+
+
+def progress_draw(progress, force=False):
+    '''
+    draw one line for all transfers, at most a few times per second.
+    '''
+    now = time.perf_counter()
+    if not force and now - progress['drawn'] < PROGRESS_INTERVAL:
+        return
+    with progress['lock']:
+        progress['drawn'] = now
+        transfers = list(progress['transfers'].values())
+        dl = sum(transfer['dl'] for transfer in transfers)
+        total = sum(transfer['total'] or 0 for transfer in transfers)
+        received = sum(transfer['received'] for transfer in transfers)
+        done = int(50 * dl / total) if total else 0
+        sys.stdout.write("\r[%s%s] %d/%d episodes %dM/%dM %.1fkb/s " % (
+            '=' * done, ' ' * (50-done), progress['finished'],
+            progress['episodes'], dl/(1024*1024), total/(1024*1024),
+            received/((now - progress['start'])*1024)))
+        sys.stdout.flush()
+
+
+def progress_print(progress, print_func, s):
+    '''
+    print a message above the progress line.
+    '''
+    with progress['lock']:
+        sys.stdout.write('\r\033[K')
+        print_func(s)
+    progress_draw(progress, force=True)
+
+
+def throttle(limiter, size):
+    '''
+    wait until size more bytes fit in the bandwidth shared by all
+    transfers.
+    '''
+    if not limiter['rate']:
+        return
+    with limiter['lock']:
+        now = time.perf_counter()
+        limiter['next'] = max(limiter['next'], now) + size / limiter['rate']
+        delay = limiter['next'] - now - size / limiter['rate']
+    if delay > 0:
+        time.sleep(delay)
+
 
 def get_datetime_stamp():
     from datetime import datetime
     return datetime.now().strftime("_%Y%m%d_%H%M%S")
 
-def download_single(folder, url):
-    import time
-    print(url)
+def announced_sha256(headers):
+    '''
+    the sha-256 of the whole file when the server announces it, in a
+    Repr-Digest (RFC 9530) or a legacy Digest (RFC 3230) header.
+    '''
+    for header, prefix, suffix in (('Repr-Digest', 'sha-256=:', ':'),
+                                   ('Digest', 'sha-256=', '')):
+        for value in headers.get(header, '').split(','):
+            value = value.strip()
+            if value.lower().startswith(prefix):
+                value = value[len(prefix):len(value) - len(suffix)]
+                try:
+                    return base64.b64decode(value).hex()
+                except ValueError:
+                    return None
+    return None
+
+
+def download_single(folder, url, progress):
+    '''
+    download url into folder and return the file name and its sha256.
+    data goes to a .part file first, which is resumed with a range
+    request if a previous run was interrupted. the file is preallocated
+    and written unbuffered, size and announced digest are checked at the
+    end.
+    '''
+    if progress['stop'].is_set():
+        raise KeyboardInterrupt
     base = CONFIGURATION['podcast-directory']
     filename = url.split('/')[-1]
     filename = filename.split('?')[0]
     tmp_list = filename.rsplit('.')
-    filename = tmp_list[0] + get_datetime_stamp() + '.' + tmp_list[-1]
-    r = requests.get(url, stream=True)
-    total_length = int(r.headers.get('content-length'))
-    print_green("{:s} downloading, len {:.3f}M".format(filename, total_length/(1024*1024)))
-    start = time.perf_counter()
-    dl = 0
-    with open(os.path.join(base, folder, filename), 'wb') as f:
-        for chunk in r.iter_content(chunk_size=1024**2):
-            f.write(chunk)
-            dl += len(chunk)
-            done = int(50 * dl / total_length)
-            sys.stdout.write("\r[%s%s] %dM %.1fkb/s" % ('=' * done, ' ' * (50-done), dl/(1024*1024), dl/((time.perf_counter() - start)*1024)))
-            sys.stdout.flush()
-    print("\ndone.")
+    part = os.path.join(base, folder, '.{}.{}.part'.format(
+        tmp_list[0], hashlib.sha1(url.encode('utf-8')).hexdigest()[:12]))
+    dl = os.path.getsize(part) if os.path.exists(part) else 0
+    headers = {'Range': 'bytes={}-'.format(dl)} if dl else {}
+    r = get_session().get(url, stream=True, headers=headers,
+                          timeout=DOWNLOAD_TIMEOUT)
+    if r.status_code == 416:  # stale .part, start over
+        r.close()
+        dl = 0
+        r = get_session().get(url, stream=True, timeout=DOWNLOAD_TIMEOUT)
+    r.raise_for_status()
+    if r.status_code != 206:  # server ignored the range
+        dl = 0
+    length = r.headers.get('content-length')
+    if 'content-encoding' in r.headers:  # length is not the file size
+        length = None
+    transfer = {
+        'dl': dl,
+        'total': dl + int(length) if length else None,
+        'received': 0,
+    }
+    with progress['lock']:
+        progress['transfers'][url] = transfer
+    sha256 = hashlib.sha256()
+    with r, open(part, 'r+b' if dl else 'wb', buffering=0) as f:
+        # the part already there is hashed, then appended to
+        buf = bytearray(DOWNLOAD_CHUNK_SIZE)
+        view = memoryview(buf)
+        while f.tell() < dl:
+            n = f.readinto(view[:dl - f.tell()])
+            sha256.update(view[:n])
+        if length and hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(f.fileno(), dl, int(length))
+            except OSError:
+                pass
+        try:
+            for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                if progress['stop'].is_set():
+                    raise KeyboardInterrupt
+                throttle(progress['limiter'], len(chunk))
+                # an unbuffered write may take only part of the chunk
+                data = memoryview(chunk)
+                while data:
+                    data = data[f.write(data):]
+                sha256.update(chunk)
+                transfer['dl'] += len(chunk)
+                transfer['received'] += len(chunk)
+                progress_draw(progress)
+        finally:
+            # drop the preallocated tail, the part resumes from its size
+            f.truncate(transfer['dl'])
+    if transfer['total'] is not None and transfer['dl'] != transfer['total']:
+        raise IOError('incomplete download, {} of {} bytes'.format(
+            transfer['dl'], transfer['total']))
+    sha256 = sha256.hexdigest()
+    expected = announced_sha256(r.headers)
+    if expected and expected != sha256:
+        os.unlink(part)
+        raise IOError('sha256 mismatch, got {} instead of {}'.format(
+            sha256, expected))
+    # parallel transfers of same named files may finish in the same second
+    stamp = get_datetime_stamp()
+    for i in itertools.count():
+        filename = tmp_list[0] + stamp + (i and '_{}'.format(i) or '') + \
+            '.' + tmp_list[-1]
+        target = os.path.join(base, folder, filename)
+        try:
+            os.link(part, target)
+            break
+        except FileExistsError:
+            continue
+        except OSError:
+            # no hard links on this filesystem (FAT, some network mounts)
+            if os.path.exists(target):
+                continue
+            os.replace(part, target)
+            return filename, sha256
+    os.unlink(part)
+    return filename, sha256
 
 
 def available_feeds():
@@ -239,23 +926,102 @@ def available_feeds():
     #for every folder, check wether a configuration file exists.
     results = []
     for shortname in paths:
-        with open(get_feed_file(shortname), 'r') as f:
-            feed = json.load(f)
-            results.append(feed)
+        results.append(read_feed_file(get_feed_file(shortname)))
     return sorted(results, key=lambda k: k['title'])
 
 
+def get_index_file():
+    return os.path.join(CONFIGURATION['podcast-directory'], 'index.json')
+
+
+def index_entry(feed):
+    '''
+    what listing feeds needs to know about a feed, without its episodes.
+    '''
+    base = CONFIGURATION['podcast-directory']
+    episodes, downloaded, newest_downloaded = episode_counts(
+        feed['shortname'])
+    return {
+        'shortname': feed['shortname'],
+        'title': feed['title'],
+        'path': os.path.relpath(get_feed_file(feed['shortname']), base),
+        'episodes': episodes,
+        'downloaded': downloaded,
+        'newest_downloaded': newest_downloaded,
+        'updated': time.time(),
+    }
+
+
+def write_index(index):
+    filename = get_index_file()
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'w') as f:
+        json.dump(index, f, indent=4)
+    os.replace(tmp_filename, filename)
+
+
+def rebuild_index():
+    '''
+    index every feed.json found in the podcast directory.
+    '''
+    index = {feed['shortname']: index_entry(feed)
+             for feed in available_feeds()}
+    write_index(index)
+    return index
+
+
+def load_index():
+    '''
+    the index maps each shortname to its feed.json and a summary of the
+    feed, it is rebuilt when missing, e.g. after upgrading podfox.
+    '''
+    try:
+        with open(get_index_file(), 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return rebuild_index()
+
+
+def update_index(feed, old_shortname=None):
+    '''
+    refresh the index entry of a feed after writing its feed.json.
+    '''
+    index = load_index()
+    index.pop(old_shortname, None)
+    index[feed['shortname']] = index_entry(feed)
+    write_index(index)
+
+
+def indexed_feeds():
+    '''
+    index entries of all feeds sorted by title, as available_feeds()
+    would list them but without loading any feed.json.
+    '''
+    base = CONFIGURATION['podcast-directory']
+    entries = [entry for entry in load_index().values()
+               if os.path.isfile(os.path.join(base, entry['path']))]
+    return sorted(entries, key=lambda k: k['title'])
+
+
 def find_feed(shortname):
     '''
     all feeds are identified by their shortname, which is also the name of
     the folder they will be stored in.
-    this function will find the correct folder, and parse the json file
-    within that folder to generate the feed data
+    this function will find the correct folder in the index, and parse the
+    json file within that folder to generate the feed data
     '''
-    feeds = available_feeds()
-    for feed in feeds:
-        if feed['shortname'] == shortname:
-            return feed
+    entry = load_index().get(shortname)
+    if entry:
+        filename = os.path.join(CONFIGURATION['podcast-directory'],
+                                entry['path'])
+    else:
+        filename = get_feed_file(shortname)
+    try:
+        feed = read_feed_file(filename)
+    except FileNotFoundError:
+        return None
+    if feed['shortname'] == shortname:
+        return feed
     return None
 
 def rename(shortname, newname):
@@ -264,29 +1030,129 @@ def rename(shortname, newname):
     if not os.path.isdir(folder):
         print_err('folder {0} not found'.format(folder))
         exit(-1)
-    os.rename(folder, new_folder)
     feed = find_feed(shortname)
+    os.rename(folder, new_folder)
+    rename_episodes(shortname, newname)
     feed['shortname'] = newname
-    overwrite_config(feed)
+    overwrite_config(feed, old_shortname=shortname)
+
+def check_feed(url):
+    '''
+    parse the feed at url with the streaming parser and with feedparser,
+    print the episodes only one of them found. returns True if they agree.
+    '''
+    r = get_session().get(url, timeout=FETCH_TIMEOUT)
+    r.raise_for_status()
+    keys = ('published', 'title', 'url', 'guid')
+    streamed = {tuple(episode[key] for key in keys)
+                for episode in stream_episodes(io.BytesIO(r.content), {})}
+    parsed = {tuple(episode[key] for key in keys)
+              for episode in episodes_from_feed(feedparser.parse(r.content))}
+    for name, episodes in (('streaming', streamed - parsed),
+                           ('feedparser', parsed - streamed)):
+        for episode in sorted(episodes):
+            print_err('only {}: {}'.format(name, ' | '.join(map(str, episode))))
+    print('{} episodes streamed, {} from feedparser'.format(
+        len(streamed), len(parsed)))
+    return streamed == parsed
+
+
+def benchmark(episodes):
+    '''
+    time merging a fetched feed into a stored feed of the given size,
+    half of the fetched episodes are new, half were stored already. the
+    feed is stored in a scratch database.
+    '''
+    def synthetic(first, last):
+        return [{'title': 'episode {}'.format(i),
+                 'url': 'http://example.com/{}.mp3'.format(i),
+                 'guid': 'guid-{}'.format(i),
+                 'downloaded': False,
+                 'listened': False,
+                 'published': 1500000000.0 + i * 3600}
+                for i in range(last, first, -1)]
+
+    global db
+    with tempfile.TemporaryDirectory() as tmpdir:
+        CONFIGURATION['podcast-directory'] = tmpdir
+        insert_episodes('benchmark', synthetic(0, episodes))
+        fetched = synthetic(episodes // 2, episodes + episodes // 2)
+        start = time.perf_counter()
+        new_episodes = merge_episodes(known_episode_keys('benchmark'),
+                                      fetched)
+        insert_episodes('benchmark', new_episodes)
+        elapsed = time.perf_counter() - start
+        start = time.perf_counter()
+        mark_downloaded(load_episodes('benchmark', downloaded=False,
+                                      limit=1)[0])
+        flag_elapsed = time.perf_counter() - start
+        db.close()
+        db = None
+    print('merged {} fetched into {} stored episodes: {} new in {:.1f}ms'
+          .format(len(fetched), episodes, len(new_episodes),
+                  elapsed * 1000))
+    print('flagged the newest undownloaded episode in {:.2f}ms'
+          .format(flag_elapsed * 1000))
+
+
+def benchmark_http(count):
+    '''
+    count tcp connections a local keep-alive server sees for count feed
+    fetches and downloads, first with a new connection per request as
+    podfox used to do, then through the pooled session.
+    '''
+    body = b'x' * 64 * 1024
+    connections = []
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def setup(self):
+            connections.append(self.client_address)
+            super().setup()
+
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:{}/episode.mp3'.format(server.server_port)
+    for name, get in (('new connection', requests.get),
+                      ('pooled session', get_session().get)):
+        del connections[:]
+        start = time.perf_counter()
+        for i in range(count):
+            get(url, timeout=DOWNLOAD_TIMEOUT).content
+        elapsed = time.perf_counter() - start
+        print('{:15}: {} requests, {} connections in {:.1f}ms'.format(
+            name, count, len(connections), elapsed * 1000))
+    server.shutdown()
+
 
 def pretty_print_feeds(feeds):
     format_str = Fore.GREEN + '{0:45.45} |'
     format_str += Fore.BLUE + '  {1:40}' + Fore.RESET + Back.RESET
     print(format_str.format('title', 'shortname'))
     print('='*80)
-    for feed in feeds:
+    for entry in feeds:
         format_str = Fore.GREEN + '{0:40.40} {1:3d}{2:1.1} |'
         format_str += Fore.BLUE + '  {3:40}' + Fore.RESET + Back.RESET
-        feed = sort_feed(feed)
-        amount = len([ep for ep in feed['episodes'] if ep['downloaded']])
-        dl = '' if feed['episodes'][0]['downloaded'] else '*'
-        print(format_str.format(feed['title'], amount, dl, feed['shortname']))
+        dl = '' if entry['newest_downloaded'] else '*'
+        print(format_str.format(entry['title'], entry['downloaded'], dl,
+                                entry['shortname']))
 
 
 def pretty_print_episodes(feed):
     format_str = Fore.GREEN + '{0:40}  |'
     format_str += Fore.BLUE + '  {1:20}' + Fore.RESET + Back.RESET
-    for e in feed['episodes'][:20]:
+    for e in load_episodes(feed['shortname'], limit=20):
         status = 'Downloaded' if e['downloaded'] else 'Not Downloaded'
         print(format_str.format(e['title'][:40], status))
 
@@ -295,6 +1161,14 @@ def main():
     global CONFIGURATION
     colorama.init()
     arguments = docopt(__doc__, version='p0d 0.01')
+    if arguments['benchmark']:
+        benchmark(int(arguments['--episodes']))
+        exit(0)
+    if arguments['benchmark-http']:
+        benchmark_http(int(arguments['--requests']))
+        exit(0)
+    if arguments['check-feed']:
+        exit(0 if check_feed(arguments['<feed-url>']) else 1)
     # before we do anything with the commands,
     # find the configuration file
 
@@ -307,14 +1181,23 @@ def main():
             exit(-1)
     #handle the commands
     if arguments['import']:
-        if arguments['<shortname>'] is None:
-            import_feed(arguments['<feed-url>'])
-        else:
-            import_feed(arguments['<feed-url>'],
-                        shortname=arguments['<shortname>'])
+        if arguments['--from-file']:
+            jobs = arguments['--jobs'] and int(arguments['--jobs'])
+            import_feeds(arguments['--from-file'], jobs)
+            exit(0)
+        try:
+            if arguments['<shortname>'] is None:
+                import_feed(arguments['<feed-url>'])
+            else:
+                import_feed(arguments['<feed-url>'],
+                            shortname=arguments['<shortname>'])
+        except requests.RequestException as e:
+            print_err('could not fetch {}: {}'.format(
+                arguments['<feed-url>'], e))
+            exit(-1)
         exit(0)
     if arguments['feeds']:
-        pretty_print_feeds(available_feeds())
+        pretty_print_feeds(indexed_feeds())
         exit(0)
     if arguments['episodes']:
         feed = find_feed(arguments['<shortname>'])
@@ -329,34 +1212,39 @@ def main():
             feed = find_feed(arguments['<shortname>'])
             if feed:
                 print_green('updating {}'.format(feed['title']))
-                update_feed(feed)
+                try:
+                    update_feed(feed)
+                except requests.RequestException as e:
+                    print_err('updating {} failed: {}'.format(
+                        feed['title'], e))
+                    exit(-1)
                 exit(0)
             else:
                 print_err("feed {} not found".format(arguments['<shortname>']))
                 exit(-1)
         else:
-            for feed in available_feeds():
-                print_green('updating {}'.format(feed['title']))
-                update_feed(feed)
+            jobs = arguments['--jobs']
+            update_feeds(available_feeds(), jobs=jobs and int(jobs))
             exit(0)
     if arguments['download']:
         if arguments['--how-many']:
             maxnum = int(arguments['--how-many'])
         else:
             maxnum = CONFIGURATION['maxnum']
+        jobs = arguments['--jobs'] and int(arguments['--jobs'])
+        rate = arguments['--rate'] and float(arguments['--rate'])
         #download episodes for a specific feed
         if arguments['<shortname>']:
             feed = find_feed(arguments['<shortname>'])
             if feed:
-                download_multiple(feed, maxnum)
+                download_multiple(feed, maxnum, jobs, rate)
                 exit(0)
             else:
                 print_err("feed {} not found".format(arguments['<shortname>']))
                 exit(-1)
         #download episodes for all feeds.
         else:
-            for feed in available_feeds():
-                download_multiple(feed,  maxnum)
+            download_episodes(available_feeds(), maxnum, jobs, rate)
             exit(0)
     if arguments['rename']:
         rename(arguments['<shortname>'], arguments['<newname>'])
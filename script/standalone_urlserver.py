@@ -1,26 +1,56 @@
 import argparse
-import ast
 import base64
+import datetime
+import email.utils
 import html
+import mmap
+import os
 import re
 import socket
 import string
+import struct
+import threading
+import time
 import urllib.request
-from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 SCRIPT_NAME = "urlserver"
 SCRIPT_AUTHOR = "Sébastien Helleu <flashcode@flashtux.org>"
 SCRIPT_VERSION = "2.6"
 SCRIPT_LICENSE = "GPL3"
 SCRIPT_DESC = "Shorten URLs with own HTTP server"
-SCRIPT_FILENAME = "/tmp/shorten_url.list"
+SCRIPT_FILENAME = "/tmp/shorten_url.db"
+
+# store written by shorten_url: slot 0 is the header, slot n the record of
+# short url number n
+STORE_MAGIC = b"SURL"
+STORE_VERSION = 1
+STORE_SLOT_SIZE = 4096
+STORE_MAX_NUMBER = 500
+STORE_HEADER = struct.Struct("<4sHHIIQ")
+STORE_RECORD = struct.Struct("<IdHH")
+
+URLSERVER_YOUTUBE_REGEX = re.compile(r"v=([\w\d]+)")
+URLSERVER_MAX_HEADER_SIZE = 65536
+# seconds to receive a request, the keep-alive timeout only applies between
+# requests
+URLSERVER_REQUEST_TIMEOUT = 0.3
 
 SCRIPT_COMMAND = "urlserver"
 SCRIPT_BUFFER = "urlserver"
 
 urlserver = {
     "socket": None,
-    "urls": {},
+    "stop": threading.Event(),
+    "lock": threading.Lock(),
+    "idle": None,
+    "store": None,
+    "store_id": None,
+    "sequence": None,
+    "views": {},
+    "pages": {},
+    "modified": 0,
+    "generation": 0,
     "number": 0,
 }
 
@@ -96,6 +126,23 @@ urlserver_settings_default = {
     ),
     "http_time_format": ("%d/%m/%y %H:%M:%S", "time format in the HTML page"),
     "http_open_in_new_page": ("on", "open links in new pages/tabs"),
+    "http_max_workers": (
+        "64",
+        "maximum number of connections served in parallel",
+    ),
+    "http_keepalive_timeout": (
+        "5",
+        "seconds an idle persistent connection is kept open",
+    ),
+    "http_keepalive_max": (
+        "100",
+        "maximum number of requests served on one persistent connection",
+    ),
+    "http_keepalive_max_idle": (
+        "16",
+        "maximum number of idle persistent connections holding a worker, "
+        "further connections are closed after their response",
+    ),
     "debug": ("off", "print some debug messages"),
 }
 urlserver_settings = {k: v[0] for k, v in urlserver_settings_default.items()}
@@ -162,41 +209,45 @@ def urlserver_get_base_url():
 
 
 def urlserver_server_reply(
-    conn, code, extra_header, message, mimetype="text/html"
+    request, code, extra_header, message, mimetype="text/html"
 ):
-    """Send a HTTP reply to client."""
+    """
+    Send a HTTP reply to client, the body is left out for a HEAD request and
+    the connection is announced as closed when it won't be kept alive.
+    """
+    if type(message) is not bytes:
+        message = message.encode("utf-8")
+    headers = ["HTTP/1.1 %s" % code]
     if extra_header:
-        extra_header += "\r\n"
-    s = "HTTP/1.1 %s\r\n%sContent-Type: %s\r\nContent-Length: %d\r\n\r\n" % (
-        code,
-        extra_header,
-        mimetype,
-        len(message),
-    )
-    msg = None
-    if type(message) is bytes:
-        msg = s.encode("utf-8") + message
-    else:
-        msg = s.encode("utf-8") + message.encode("utf-8")
+        headers.append(extra_header)
+    headers.append("Content-Type: %s" % mimetype)
+    # a 304 has no body, its length would be taken for the cached page's
+    if not code.startswith("304"):
+        headers.append("Content-Length: %d" % len(message))
+    if not request["keep_alive"]:
+        headers.append("Connection: close")
+    msg = ("\r\n".join(headers) + "\r\n\r\n").encode("utf-8")
+    if request["method"] != "HEAD":
+        msg += message
     if urlserver_settings["debug"] == "on":
         print("urlserver: sending %d bytes" % len(msg))
-    conn.sendall(msg)
+    request["conn"].sendall(msg)
 
 
-def urlserver_server_reply_auth_required(conn):
+def urlserver_server_reply_auth_required(request):
     """Reply a 401 (authorization required)."""
     urlserver_server_reply(
-        conn,
+        request,
         "401 Authorization required",
         f'WWW-Authenticate: Basic realm="{SCRIPT_NAME}"',
         "",
     )
 
 
-def urlserver_server_reply_404_not_found(conn):
+def urlserver_server_reply_404_not_found(request):
     """Reply a 404 (not found)."""
     urlserver_server_reply(
-        conn,
+        request,
         "404 Not found",
         "",
         "<html>\n"
@@ -251,14 +302,40 @@ def urlserver_server_favicon():
     return base64_decode(s)
 
 
-def urlserver_server_reply_list(conn, sort="-time"):
-    """Send list of URLs as HTML page to client."""
-    content = '<div class="urls">\n<table id="urls_table">\n'
+def urlserver_render_css():
+    """Return CSS block (or link to external CSS) of HTML page."""
+    if len(urlserver_settings["http_css_url"]) > 0:
+        return (
+            '<link rel="stylesheet" type="text/css" href="%s" />'
+            % urlserver_settings["http_css_url"]
+        )
+    return (
+        '<style type="text/css" media="screen">'
+        "<!--\n"
+        "  html { font-family: Verdana, Arial, Helvetica; "
+        "font-size: 12px; background: %s; color: %s }\n"
+        "  .urls table { border-collapse: collapse }\n"
+        "  .urls table td,th { border: solid 1px #cccccc; "
+        "padding: 4px; font-size: 12px }\n"
+        "  .timestamp,.number,.short_url{ white-space: nowrap }\n"
+        "  .sorted_by { font-style: italic; }\n"
+        "  .obj { margin-top: 1em }\n"
+        "-->"
+        "</style>\n"
+        % (
+            urlserver_settings["http_bg_color"],
+            urlserver_settings["http_fg_color"],
+        )
+    )
+
+
+def urlserver_render_list(urls, sort="-time"):
+    """Return list of URLs as HTML page."""
+    content = ['<div class="urls">\n<table id="urls_table">\n', "  <tr>"]
     sortkey = {"-": ("", "&uarr;"), "+": ("-", "&darr;")}
-    content += "  <tr>"
     for column, defaultsort in (("time", "-"), ("number", "-")):
         if sort[1:] == column:
-            content += (
+            content.append(
                 '<th class="sortable sorted_by %s_header">'
                 '<a href="sort=%s%s">%s</a> %s</th>'
                 % (
@@ -270,44 +347,55 @@ def urlserver_server_reply_list(conn, sort="-time"):
                 )
             )
         else:
-            content += (
+            content.append(
                 '<th class="sortable %s_header">'
                 '<a class="sort_link" href="sort=%s%s">%s</a></th>'
                 % (column, defaultsort, column, column.capitalize())
             )
 
-    content += (
+    content.append(
         '<th class="unsortable message_header">Short URLs</th>'
         '<th class="unsortable message_header">Convention URLs message</th>'
         "</tr>\n"
     )
 
-    for key, item in urlserver["urls"].items():
-        content += "  <tr>"
+    # everything which does not depend on the URL is computed once per page
+    short_url_e = "\x01\x02\x03\x04"
+    url_e = "\x05\x06\x07\x08"
+    message_e = html.escape(
+        f"Shorten url script:\t convert {url_e} to {short_url_e}"
+    ).split("\t", 1)
+    strjoin = (
+        '<span class="prefix_suffix"> %s </span>'
+        % urlserver_settings["http_prefix_suffix"].replace(" ", "&nbsp;")
+    )
+    message_e = strjoin.join(
+        [
+            '<span class="prefix">%s</span>' % message_e[0],
+            '<span class="message">%s</span>' % message_e[1],
+        ]
+    )
+    if urlserver_settings["http_open_in_new_page"] == "on":
+        target = "_blank"
+    else:
+        target = "_self"
+    href = (
+        '</span><a class="%s" href="%s" title="%s" target="%s">'
+        '%s</a><span class="message">'
+    )
+    embed_image = urlserver_settings["http_embed_image"] == "on"
+    embed_youtube = urlserver_settings["http_embed_youtube"] == "on"
+    try:
+        size = urlserver_settings["http_embed_youtube_size"].split("*")
+        width = int(size[0])
+        height = int(size[1])
+    except:
+        width = 480
+        height = 350
+
+    for key, item in urls:
         short_url = item[1]
-        short_url_e = "\x01\x02\x03\x04"
         url = item[2]
-        url_e = "\x05\x06\x07\x08"
-        message = html.escape(
-            f"Shorten url script:\t convert {url_e} to {short_url_e}"
-        ).split("\t", 1)
-        message[0] = '<span class="prefix">%s</span>' % message[0]
-        message[1] = '<span class="message">%s</span>' % message[1]
-
-        strjoin = (
-            '<span class="prefix_suffix"> %s </span>'
-            % urlserver_settings["http_prefix_suffix"].replace(" ", "&nbsp;")
-        )
-
-        if urlserver_settings["http_open_in_new_page"] == "on":
-            target = "_blank"
-        else:
-            target = "_self"
-
-        href = (
-            '</span><a class="%s" href="%s" title="%s" target="%s">'
-            '%s</a><span class="message">'
-        )
         short_url_href = href % (
             "short_url",
             url,
@@ -330,38 +418,22 @@ def urlserver_server_reply_list(conn, sort="-time"):
             target,
             display_url,
         )
-        message = (
-            strjoin.join(message)
-            .replace(short_url_e, short_url_href)
-            .replace(url_e, url_href)
+        message = message_e.replace(short_url_e, short_url_href).replace(
+            url_e, url_href
         )
 
         obj = ""
-        if urlserver_settings[
-            "http_embed_image"
-        ] == "on" and url.lower().endswith(
+        if embed_image and url.lower().endswith(
             (".jpg", ".jpeg", ".png", ".gif", ".bmp", ".svg")
         ):
             obj = (
                 '<div class="obj"><img src="%s" title="%s" alt="%s">'
                 "</div>" % (url, url, url)
             )
-        elif (
-            urlserver_settings["http_embed_youtube"] == "on"
-            and "youtube.com/" in url
-        ):
-            m = re.search(r"v=([\w\d]+)", url)
+        elif embed_youtube and "youtube.com/" in url:
+            m = URLSERVER_YOUTUBE_REGEX.search(url)
             if m:
                 yid = m.group(1)
-                try:
-                    size = urlserver_settings["http_embed_youtube_size"].split(
-                        "*"
-                    )
-                    width = int(size[0])
-                    height = int(size[1])
-                except:
-                    width = 480
-                    height = 350
                 obj = (
                     '<div class="obj youtube">'
                     '<iframe id="%s" type="text/html" width="%d" '
@@ -370,41 +442,16 @@ def urlserver_server_reply_list(conn, sort="-time"):
                     "</iframe></div>" % (yid, width, height, yid)
                 )
 
-        content += (
-            '<td class="timestamp">%s</td>'
+        content.append(
+            '  <tr><td class="timestamp">%s</td>'
             '<td class="number" style="text-align:center">%s</td>'
             '<td class="short_url">%s</td>'
-            '<td class="message">' % (key, item[0], item[1])
+            '<td class="message">%s%s</td></tr>\n'
+            % (key, item[0], item[1], message, obj)
         )
-        content += "%s%s</td></tr>\n" % (message, obj)
-    content += "</table>"
+    content.append("</table>")
 
-    if len(urlserver_settings["http_css_url"]) > 0:
-        css = (
-            '<link rel="stylesheet" type="text/css" href="%s" />'
-            % urlserver_settings["http_css_url"]
-        )
-    else:
-        css = (
-            '<style type="text/css" media="screen">'
-            "<!--\n"
-            "  html { font-family: Verdana, Arial, Helvetica; "
-            "font-size: 12px; background: %s; color: %s }\n"
-            "  .urls table { border-collapse: collapse }\n"
-            "  .urls table td,th { border: solid 1px #cccccc; "
-            "padding: 4px; font-size: 12px }\n"
-            "  .timestamp,.number,.short_url{ white-space: nowrap }\n"
-            "  .sorted_by { font-style: italic; }\n"
-            "  .obj { margin-top: 1em }\n"
-            "-->"
-            "</style>\n"
-            % (
-                urlserver_settings["http_bg_color"],
-                urlserver_settings["http_fg_color"],
-            )
-        )
-
-    html_code = (
+    return (
         "<html>\n"
         "<head>\n"
         "<title>%s</title>\n"
@@ -418,12 +465,47 @@ def urlserver_server_reply_list(conn, sort="-time"):
         "</html>"
         % (
             urlserver_settings["http_title"],
-            css,
+            urlserver_render_css(),
             urlserver_get_base_url(),
-            content,
+            "".join(content),
         )
     )
-    urlserver_server_reply(conn, "200 OK", "", html_code)
+
+
+def urlserver_check_not_modified(data, etag, modified):
+    """Check conditional request headers against a cached page."""
+    m = re.search(
+        r"^If-None-Match:[ \t]*(.+)$", data, re.MULTILINE | re.IGNORECASE
+    )
+    if m:
+        tags = [tag.strip() for tag in m.group(1).split(",")]
+        return "*" in tags or etag in tags
+    m = re.search(
+        r"^If-Modified-Since:[ \t]*(.+)$", data, re.MULTILINE | re.IGNORECASE
+    )
+    if m:
+        try:
+            since = email.utils.parsedate_to_datetime(m.group(1).strip())
+            return int(modified) <= since.timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def urlserver_server_reply_list(request, sort="-time"):
+    """
+    Send list of URLs as HTML page to client, the page is rendered once per
+    store change and sort order, then replied from cache or with a 304.
+    """
+    etag, modified, body = urlserver_list_page(sort)
+    headers = "ETag: %s\r\nLast-Modified: %s\r\nCache-Control: no-cache" % (
+        etag,
+        email.utils.formatdate(modified, usegmt=True),
+    )
+    if urlserver_check_not_modified(request["data"], etag, modified):
+        urlserver_server_reply(request, "304 Not Modified", headers, b"")
+    else:
+        urlserver_server_reply(request, "200 OK", headers, body)
 
 
 def urlserver_check_auth(data):
@@ -440,12 +522,65 @@ def urlserver_check_auth(data):
     return False
 
 
-def urlserver_server_fd_cb():
-    """Callback for server socket."""
-    if not urlserver["socket"]:
-        return False
-
-    conn, addr = urlserver["socket"].accept()
+def urlserver_parse_request(buf):
+    """
+    Parse the request at start of buf, return (request, consumed bytes) or
+    None if it is not complete yet. Raise ValueError for a bad request.
+    """
+    start = 0
+    # empty lines before a request line must be ignored
+    while buf.startswith(b"\r\n", start):
+        start += 2
+    end = buf.find(b"\r\n\r\n", start)
+    if end < 0:
+        if len(buf) - start > URLSERVER_MAX_HEADER_SIZE:
+            raise ValueError("request header too large")
+        return None
+
+    lines = bytes(buf[start:end]).decode("utf-8", "ignore").split("\r\n")
+    request_line = lines[0].split(" ")
+    if len(request_line) != 3 or not request_line[2].startswith("HTTP/1."):
+        raise ValueError("bad request line")
+    method, path, version = request_line
+    headers = {}
+    for line in lines[1:]:
+        name, colon, value = line.partition(":")
+        if not colon:
+            raise ValueError("bad header line")
+        headers[name.strip().lower()] = value.strip()
+    if "chunked" in headers.get("transfer-encoding", "").lower():
+        raise ValueError("chunked request body not supported")
+    # a body is useless for GET/HEAD, but it has to be skipped
+    length = headers.get("content-length", "0")
+    # int() takes signs, blanks and underscores, a negative length would
+    # make the same bytes parse again as another request
+    if not (length.isascii() and length.isdigit()):
+        raise ValueError("bad content-length")
+    length = int(length)
+    consumed = end + 4 + length
+    if len(buf) < consumed:
+        return None
+
+    connection = headers.get("connection", "").lower()
+    if version == "HTTP/1.0":
+        keep_alive = "keep-alive" in connection
+    else:
+        keep_alive = "close" not in connection
+    request = {
+        "method": method,
+        "path": path,
+        "headers": headers,
+        "data": "\n".join(lines),
+        "keep_alive": keep_alive,
+    }
+    return request, consumed
+
+
+def urlserver_server_fd_cb(conn, addr):
+    """
+    Serve the requests of one connection in order until client closes it or
+    stays idle, return False to stop server.
+    """
     if urlserver_settings["debug"] == "on":
         print("urlserver: connection from %s" % str(addr))
 
@@ -454,32 +589,90 @@ def urlserver_server_fd_cb():
     ):
         if urlserver_settings["debug"] == "on":
             print("urlserver: IP not allowed")
-        conn.close()
-        return False
+        return True
 
+    # a client that connects without sending must not hold a worker long
+    conn.settimeout(URLSERVER_REQUEST_TIMEOUT)
+    keepalive_timeout = float(urlserver_settings["http_keepalive_timeout"])
+    max_requests = int(urlserver_settings["http_keepalive_max"])
+    buf = bytearray()
+    served = 0
+    idle = False  # holding one of the idle keep-alive slots
     try:
-        conn.settimeout(0.3)
-        data = conn.recv(4096).decode("utf-8", "ignore")
-        data = data.replace("\r\n", "\n")
-    except:
+        while True:
+            try:
+                parsed = urlserver_parse_request(buf)
+            except ValueError as e:
+                if urlserver_settings["debug"] == "on":
+                    print(f"urlserver: {e}")
+                urlserver_server_reply(
+                    {"conn": conn, "method": "GET", "keep_alive": False},
+                    "400 Bad Request",
+                    "",
+                    "",
+                )
+                return True
+            if parsed is None:
+                try:
+                    chunk = conn.recv(65536)
+                except OSError:
+                    return True
+                if not chunk:
+                    return True
+                if idle:  # next request is coming, no longer idle
+                    urlserver["idle"].release()
+                    idle = False
+                    conn.settimeout(URLSERVER_REQUEST_TIMEOUT)
+                buf += chunk
+                continue
+
+            request, consumed = parsed
+            del buf[:consumed]
+            served += 1
+            request["conn"] = conn
+            if served >= max_requests or urlserver["stop"].is_set():
+                request["keep_alive"] = False
+            elif request["keep_alive"] and not buf:
+                # waiting for the next request holds a worker, only a few
+                # connections may do so, the others are closed
+                idle = urlserver["idle"].acquire(blocking=False)
+                request["keep_alive"] = idle
+            if not urlserver_server_request(request):
+                return False
+            if not request["keep_alive"]:
+                return True
+            if idle:
+                conn.settimeout(keepalive_timeout)
+    finally:
+        if idle:
+            urlserver["idle"].release()
+
+
+def urlserver_server_request(request):
+    """Reply to one parsed request, return False to stop server."""
+    data = request["data"]
+    if urlserver_settings["debug"] == "on":
+        print(f"urlserver: {data.partition(chr(10))[0]}")
+
+    if request["method"] not in ("GET", "HEAD"):
+        urlserver_server_reply(
+            request, "405 Method Not Allowed", "Allow: GET, HEAD", ""
+        )
         return True
 
-    referer = re.search("^Referer:", data, re.MULTILINE | re.IGNORECASE)
-    m = re.search("^GET /(.*) HTTP/.*$", data, re.MULTILINE)
-    if not m:
-        urlserver_server_reply_404_not_found(conn)
+    if not request["path"].startswith("/"):
+        urlserver_server_reply_404_not_found(request)
         return True
 
-    url = m.group(1)
-    if urlserver_settings["debug"] == "on":
-        print(f"urlserver: {m.group(0)} {url}")
+    referer = "referer" in request["headers"]
+    url = request["path"][1:]
 
     if url.lower() in ("stop", "shutdown", "close"):
         return False
 
     if "favicon." in url:
         urlserver_server_reply(
-            conn,
+            request,
             "200 OK",
             "",
             urlserver_server_favicon(),
@@ -495,24 +688,24 @@ def urlserver_server_fd_cb():
         else:
             if urlserver_settings["debug"] == "on":
                 print("urlserver: prefix missing")
+            urlserver_server_reply_404_not_found(request)
             return True
 
     sort = url[5:] if url.startswith("sort=") else "-time"
-    urlserver_read_urls(sort)
 
     if not url or url.startswith("sort="):
         # page with list of urls
         if urlserver_check_auth(data):
-            urlserver_server_reply_list(conn, sort)
+            urlserver_server_reply_list(request, sort)
         else:
-            urlserver_server_reply_auth_required(conn)
+            urlserver_server_reply_auth_required(request)
         return True
 
     # short url, read base62 key and redirect to page
     try:
         number = base62_decode(url)
     except:
-        urlserver_server_reply_404_not_found(conn)
+        urlserver_server_reply_404_not_found(request)
     else:
         long_url = urlserver_search_url(number)
         authok = urlserver_settings[
@@ -524,7 +717,7 @@ def urlserver_server_fd_cb():
             # otherwise, we can make redirection with HTTP 302
             if referer:
                 urlserver_server_reply(
-                    conn,
+                    request,
                     "200 OK",
                     "",
                     '<meta name="referrer" content="never">\n'
@@ -532,21 +725,64 @@ def urlserver_server_fd_cb():
                     'url=%s">' % long_url,
                 )
             else:
-                conn.sendall(
-                    "HTTP/1.1 302\r\nLocation: {}\r\n\r\n".format(
-                        long_url
-                    ).encode("utf-8")
+                urlserver_server_reply(
+                    request, "302 Found", f"Location: {long_url}", ""
                 )
         else:
-            urlserver_server_reply_auth_required(conn)
+            urlserver_server_reply_auth_required(request)
 
-    conn.close()
     return True
 
 
+def urlserver_server_conn_cb(conn, addr):
+    """Serve one connection in a worker thread, then close it."""
+    try:
+        if not urlserver_server_fd_cb(conn, addr):
+            urlserver["stop"].set()
+    except Exception as e:
+        if urlserver_settings["debug"] == "on":
+            print(f"urlserver: error serving {addr}: {e}")
+    finally:
+        conn.close()
+
+
+def urlserver_server_serve():
+    """
+    Accept connections and hand them to a bounded pool of worker threads,
+    so that a slow client does not delay the other ones.
+    """
+    max_workers = int(urlserver_settings["http_max_workers"])
+    # bound connections accepted but not yet served, further clients wait
+    # in the listen backlog of the kernel
+    pending = threading.BoundedSemaphore(max_workers * 2)
+
+    def _serve(conn, addr):
+        try:
+            urlserver_server_conn_cb(conn, addr)
+        finally:
+            pending.release()
+
+    urlserver["idle"] = threading.BoundedSemaphore(
+        int(urlserver_settings["http_keepalive_max_idle"])
+    )
+    urlserver["stop"].clear()
+    urlserver["socket"].settimeout(0.5)
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        while not urlserver["stop"].is_set():
+            try:
+                conn, addr = urlserver["socket"].accept()
+            except socket.timeout:
+                continue
+            pending.acquire()
+            pool.submit(_serve, conn, addr)
+
+
 def urlserver_server_start():
     """Start mini HTTP server."""
     global urlserver
+    # pages of an earlier run may differ, in their base URL for one
+    urlserver["generation"] = time.time()
+    urlserver["pages"] = {}
     hostname = urlserver_settings["http_hostname"] or socket.getfqdn()
     port = int(urlserver_settings["http_port"])
     urlserver["socket"] = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -554,7 +790,7 @@ def urlserver_server_start():
     try:
         if urlserver["socket"].connect_ex((hostname, port)):
             urlserver["socket"].bind((hostname, port))
-            urlserver["socket"].listen(5)
+            urlserver["socket"].listen(socket.SOMAXCONN)
             print(f"URL server listening on {hostname}:{port}")
         else:
             print(f"URL server already in listening on {hostname}:{port}")
@@ -578,29 +814,232 @@ def urlserver_server_stop(stop_url):
             pass
 
 
+def urlserver_store_open():
+    """Map the URL store, map it again if the file was replaced."""
+    st = os.stat(SCRIPT_FILENAME)
+    if (st.st_dev, st.st_ino) != urlserver["store_id"]:
+        with open(SCRIPT_FILENAME, "rb") as f:
+            store = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, slot_size, max_number, _, _ = (
+            STORE_HEADER.unpack_from(store, 0)
+        )
+        if (magic, version, slot_size, max_number) != (
+            STORE_MAGIC,
+            STORE_VERSION,
+            STORE_SLOT_SIZE,
+            STORE_MAX_NUMBER,
+        ):
+            store.close()
+            raise ValueError(f"{SCRIPT_FILENAME} is not a shorten url store")
+        if urlserver["store"]:
+            urlserver["store"].close()
+        urlserver["store"] = store
+        urlserver["store_id"] = (st.st_dev, st.st_ino)
+        urlserver["sequence"] = None
+    return urlserver["store"]
+
+
+def urlserver_store_record(store, number):
+    """Return (number, timestamp, short_url, url) of a slot, or None."""
+    if not 0 < number <= STORE_MAX_NUMBER:
+        return None
+    offset = number * STORE_SLOT_SIZE
+    slot_number, ts, short_url_len, url_len = STORE_RECORD.unpack_from(
+        store, offset
+    )
+    if slot_number != number:
+        return None
+    offset += STORE_RECORD.size
+    short_url = store[offset : offset + short_url_len].decode("utf-8")
+    offset += short_url_len
+    url = store[offset : offset + url_len].decode("utf-8")
+    return number, ts, short_url, url
+
+
+def urlserver_load_urls(store):
+    """Read every record of the store and build the list views."""
+    records = sorted(
+        filter(
+            None,
+            [
+                urlserver_store_record(store, number)
+                for number in range(1, STORE_MAX_NUMBER + 1)
+            ],
+        ),
+        key=lambda record: record[1],
+    )
+    time_format = urlserver_settings["http_time_format"]
+    urls = [
+        (
+            datetime.datetime.fromtimestamp(ts).strftime(time_format),
+            (number, short_url, url),
+        )
+        for number, ts, short_url, url in records
+    ]
+    by_number = sorted(urls, key=lambda url: url[1][0])
+    urlserver["views"] = {
+        "+time": urls,
+        "-time": urls[::-1],
+        "+number": by_number,
+        "-number": by_number[::-1],
+    }
+    urlserver["modified"] = records[-1][1] if records else 0
+    urlserver["number"] = STORE_HEADER.unpack_from(store, 0)[4]
+
+
+def urlserver_refresh_urls():
+    """
+    Build the views again if the sequence number in the store header
+    changed, caller must hold the lock.
+    """
+    try:
+        store = urlserver_store_open()
+        sequence = STORE_HEADER.unpack_from(store, 0)[5]
+        if sequence != urlserver["sequence"]:
+            urlserver_load_urls(store)
+            urlserver["pages"] = {}
+            urlserver["sequence"] = sequence
+    except Exception:
+        print(f"urlserver: error reading file {SCRIPT_FILENAME}")
+        urlserver["views"] = {}
+        urlserver["pages"] = {}
+        urlserver["sequence"] = None
+
+
+def urlserver_sort_view(sort):
+    """Return name of the view for a sort order given in URL."""
+    return "%s%s" % (
+        "-" if sort.startswith("-") else "+",
+        "time" if "time" in sort else "number",
+    )
+
+
 def urlserver_read_urls(sort="-time"):
-    """Read file with URLs."""
+    """Return URLs in the requested order."""
     global urlserver
-    filename = SCRIPT_FILENAME
-    try:
-        urls_dict = ast.literal_eval(open(filename, "r").read())
-        if "time" not in sort:  # sort by timestamp, default format
-            urls_dict = sorted(urls_dict.items(), key=lambda url: url[1][0])
-        urlserver["urls"] = OrderedDict(urls_dict)
-        if sort.startswith("-"):
-            urlserver["urls"] = OrderedDict(
-                reversed(list(urlserver["urls"].items()))
+    with urlserver["lock"]:
+        urlserver_refresh_urls()
+        return urlserver["views"].get(urlserver_sort_view(sort), [])
+
+
+def urlserver_list_page(sort="-time"):
+    """Return (etag, modified time, body) of list page, render it if needed."""
+    view = urlserver_sort_view(sort)
+    with urlserver["lock"]:
+        urlserver_refresh_urls()
+        if view not in urlserver["pages"]:
+            body = urlserver_render_list(
+                urlserver["views"].get(view, []), view
+            ).encode("utf-8")
+            # generation changes with the rendering settings, at startup
+            etag = '"%x-%x-%x-%s"' % (
+                (urlserver["store_id"] or (0, 0))[1],
+                urlserver["sequence"] or 0,
+                int(urlserver["generation"] * 1000),
+                view,
             )
-        urlserver["number"] = list(urlserver["urls"].values())[-1][0]
-    except:
-        print(f"urlserver: error reading file {filename}")
+            modified = max(urlserver["modified"], int(urlserver["generation"]))
+            urlserver["pages"][view] = (etag, modified, body)
+        return urlserver["pages"][view]
 
 
 def urlserver_search_url(number):
-    for val in urlserver["urls"].values():
-        if val[0] == number:
-            return val[2]
-    return None
+    """Return long URL of a short number, read straight from its slot."""
+    with urlserver["lock"]:
+        try:
+            record = urlserver_store_record(urlserver_store_open(), number)
+        except Exception:
+            print(f"urlserver: error reading file {SCRIPT_FILENAME}")
+            return None
+    return record[3] if record else None
+
+
+def urlserver_load_test(target_url, clients, requests, keep_alive=False):
+    """
+    Fire redirect requests from parallel clients at a running server and
+    print the latency distribution.
+    """
+    urls = urlserver_read_urls()
+    if not urls:
+        print(f"urlserver: no URL to redirect in {SCRIPT_FILENAME}")
+        return
+    keys = [base62_encode(item[0]) for _, item in urls]
+    hostname, port = target_url.split("://", 1)[-1].rsplit(":", 1)
+    prefix = urlserver_settings["http_url_prefix"]
+    prefix = f"{prefix}/" if prefix else ""
+    latencies = []
+    errors = []
+    start_event = threading.Event()
+
+    def _client(index):
+        start_event.wait()
+        conn = None
+        connection = "keep-alive" if keep_alive else "close"
+        for i in range(requests):
+            key = keys[(index + i) % len(keys)]
+            request = (
+                f"GET /{prefix}{key} HTTP/1.1\r\nHost: {hostname}\r\n"
+                f"Connection: {connection}\r\n\r\n"
+            ).encode("utf-8")
+            start = time.perf_counter()
+            try:
+                if conn is None:
+                    conn = socket.create_connection((hostname, int(port)), 5)
+                    reply = conn.makefile("rb")
+                conn.sendall(request)
+                status = reply.readline()
+                length = 0
+                while (line := reply.readline()) not in (b"\r\n", b""):
+                    name, _, value = line.partition(b":")
+                    if name.lower() == b"content-length":
+                        length = int(value)
+                reply.read(length)
+            except OSError as e:
+                errors.append(e)
+                status = None
+            if status is None or not keep_alive:
+                if conn is not None:
+                    reply.close()
+                    conn.close()
+                conn = None
+            if status is None:
+                continue
+            latencies.append(time.perf_counter() - start)
+            if not status.startswith(b"HTTP/1.1 302"):
+                errors.append(status.strip())
+        if conn is not None:
+            reply.close()
+            conn.close()
+
+    threads = [
+        threading.Thread(target=_client, args=(i,)) for i in range(clients)
+    ]
+    for t in threads:
+        t.start()
+    start = time.perf_counter()
+    start_event.set()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    if not latencies:
+        print(f"urlserver: all {len(errors)} requests failed")
+        return
+
+    def percentile(p):
+        return latencies[min(len(latencies) - 1, len(latencies) * p // 100)]
+
+    print(
+        f"{len(latencies)} redirects from {clients} clients "
+        f"{'on persistent connections ' if keep_alive else ''}"
+        f"in {elapsed:.2f}s "
+        f"({len(latencies) / elapsed:.0f} req/s), {len(errors)} errors\n"
+        f"latency p50 {percentile(50) * 1000:.1f}ms, "
+        f"p90 {percentile(90) * 1000:.1f}ms, "
+        f"p99 {percentile(99) * 1000:.1f}ms, "
+        f"max {latencies[-1] * 1000:.1f}ms"
+    )
 
 
 if __name__ == "__main__":
@@ -623,18 +1062,53 @@ if __name__ == "__main__":
         action="store_true",
         help=f"restart urlserver {target_url}",
     )
+    parser.add_argument(
+        "--max-workers",
+        dest="max_workers",
+        type=int,
+        default=int(urlserver_settings["http_max_workers"]),
+        help="number of connections served in parallel",
+    )
+    parser.add_argument(
+        "--load-test",
+        dest="load_test",
+        type=int,
+        metavar="CLIENTS",
+        help=f"measure redirect latency of {target_url} with parallel clients",
+    )
+    parser.add_argument(
+        "--load-test-requests",
+        dest="load_test_requests",
+        type=int,
+        default=20,
+        help="number of redirects requested by each load test client",
+    )
+    parser.add_argument(
+        "--load-test-keep-alive",
+        dest="load_test_keep_alive",
+        action="store_true",
+        help="send all redirects of a load test client on one connection",
+    )
 
     stop_url = f"{target_url}/stop"
     args = parser.parse_args()
+    urlserver_settings["http_max_workers"] = str(args.max_workers)
+    if args.load_test:
+        urlserver_load_test(
+            target_url,
+            args.load_test,
+            args.load_test_requests,
+            args.load_test_keep_alive,
+        )
+        exit()
     if args.stop or args.restart:
         urlserver_server_stop(stop_url)
     if args.restart or not args.stop:
         # start mini HTTP server
         urlserver_server_start()
         try:
-            on_listening = True
-            while on_listening:
-                on_listening = urlserver_server_fd_cb()
+            if urlserver["socket"]:
+                urlserver_server_serve()
         except KeyboardInterrupt:
             print("Terminated by keyboard interrupt, bye")
         finally: